@@ -1,27 +1,47 @@
 import argparse
 from datetime import date
 import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
 from model.utilities.config import config
 from model.utilities.data import Data, Image, Stream
 from model.inference import Predict
+from model.pipeline import Pipeline
+from model.utilities.image import AsyncVideoWriter
+from model.utilities.metrics import metrics
+from model.utilities.runtime import configure_threads
+from model.utilities.utils import subject_exists
 from collections import defaultdict
 
 
 class Attendance:
     MODE = "image/video"
 
-    def __init__(self, subject, threshold, model=None):
-        self.model = model if isinstance(model, Predict) else Predict()
+    def __init__(self, subject, threshold, model=None, pipeline=config.PIPELINE, headless=config.HEADLESS, sink=None):
+        self.__model = model if isinstance(model, Predict) else None
         self.subject = subject
         self.threshold = threshold
+        self.pipeline = pipeline
+        self.headless = headless
+        self.sink = sink
         self.records = []
         self.attendance = {}
         self.attendance_sheet, self.enrolled_std_labels = self.load()
 
-    def record(self, path):
+    @property
+    def model(self):
+        return self.warm_up()
+
+    def warm_up(self):
+        # the detector and FaceNet are only built once a file is to be recognized in this process
+        if self.__model is None:
+            self.__model = Predict()
+        return self.__model
+
+    def record(self, path, workers=config.RECORD_WORKERS):
         if path == 0:
             self.camera()
             return
@@ -30,15 +50,46 @@ class Attendance:
         files.extend(Data.load(path, loaders=[Image]).get(Image.__name__, []))
         files.extend(Data.load(path, loaders=[Stream]).get(Stream.__name__, []))
 
-        for file in files:
-            recorder = Recorder(self, file=file)
-            recorder.start()
-            self.records.append(recorder)
+        if workers > 1 and len(files) > 1:
+            self.record_parallel(files, workers=workers)
+        else:
+            # build the model before the recorders copy the attendance so that they share it
+            if not self.pipeline or any(isinstance(file, Image) for file in files):
+                self.warm_up()
+
+            for file in files:
+                recorder = Recorder(self, file=file)
+                recorder.start()
+                self.records.append(recorder)
 
         self.attendance.update(Recorder.merge(self.records))
 
+    def record_parallel(self, files, workers):
+        """
+        record the files on a pool of processes, each holding its own detector and model
+        :param files: list of `Image` and `Stream` objects
+        :param workers: number of processes
+        """
+        # tensorflow and dlib are not fork safe once initialized
+        context = mp.get_context("spawn")
+        tasks = [(type(file), file.path) for file in files]
+        workers = min(workers, len(files))
+
+        # the spawned workers inherit the thread limits exported by the parent,
+        # the counter hands every worker its own index and so its own cores
+        configure_threads()
+        counter = context.Value('i', 0)
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                 initargs=(self.subject, self.threshold, counter, workers)) as executor:
+            for file, entities in zip(files, executor.map(record_file, *zip(*tasks))):
+                recorder = Recorder(self, file=file)
+                recorder.entities = entities
+                self.records.append(recorder)
+
     def camera(self):
         camera = Stream(path=0, display=True)
+        self.warm_up()
         recorder = Recorder(self, file=camera)
         recorder.start()
         self.attendance.update(recorder.entities)
@@ -77,10 +128,7 @@ class Attendance:
 
     @staticmethod
     def exist(subject):
-        path = os.path.join(config.TRAINED_DATA, f"{subject}{config.CLASSIFIER_FILE_SUFFIX}.sav")
-        if os.path.isfile(path):
-            return subject
-        return False
+        return subject_exists(subject)
 
     def __str__(self):
         return f"<Attendance: {self.subject}>"
@@ -90,7 +138,9 @@ class Recorder(Attendance):
     def __init__(self, parent=None, **kwargs):
         if isinstance(parent, Attendance):
             self.__dict__ = parent.__dict__.copy()
+            self.parent = parent
         else:
+            self.parent = None
             parent_params = {}
             if kwargs.get("model"):
                 parent_params["model"] = kwargs.get("model")
@@ -102,6 +152,12 @@ class Recorder(Attendance):
         self.file = kwargs.get("file")
         self.entities = {}
 
+    def warm_up(self):
+        # recorders share the model of their attendance, it is built at most once per process
+        if self.parent is not None:
+            return self.parent.warm_up()
+        return super(Recorder, self).warm_up()
+
     @staticmethod
     def merge(records):
         merged = defaultdict(list)
@@ -124,7 +180,12 @@ class Recorder(Attendance):
             self.image()
 
     def video(self):
-        entities = self.file(model=self.model, subject=self.subject, threshold=self.threshold)
+        if self.pipeline:
+            # run detection, encoding and classification in separate worker processes
+            entities = Pipeline(subject=self.subject, threshold=self.threshold)(self.file)
+        else:
+            entities = self.file(model=self.model, subject=self.subject, threshold=self.threshold,
+                                 headless=self.headless and not self.file.display, sink=self.sink)
         for label, tracker in entities.items():
             self.entities.setdefault(label, tracker.probability)
 
@@ -136,11 +197,41 @@ class Recorder(Attendance):
             self.entities.setdefault(label, probability)
 
 
+# attendance of the worker process used by `Attendance.record_parallel`
+worker = None
+
+
+def init_worker(subject, threshold, counter, workers):
+    global worker
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+
+    configure_threads(worker=index, workers=workers)
+    worker = Attendance(subject=subject, threshold=threshold, pipeline=False)
+    # load the detector and FaceNet once so that every file of the worker reuses them
+    worker.warm_up()
+
+
+def record_file(loader, path):
+    recorder = Recorder(worker, file=loader(path))
+    recorder.start()
+    return recorder.entities
+
+
 def main(arguments):
-    attendance = Attendance(subject=arguments.subject, threshold=27)
+    metrics.enabled = metrics.enabled or arguments.metrics is not None
+    sink = AsyncVideoWriter(arguments.video) if arguments.video else None
+    attendance = Attendance(subject=arguments.subject, threshold=27, sink=sink)
     attendance.record(path=0)
     attendance.mark()
 
+    if sink is not None:
+        sink.close()
+
+    if arguments.metrics:
+        metrics.dump(arguments.metrics)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Mark Attendance using the faces in the images')
@@ -148,6 +239,10 @@ if __name__ == '__main__':
                         default=os.path.join(config.BASE_DIR, 'test-data'))
     parser.add_argument('-c', '--subject', help='path to the class folder which attendance is to be taken',
                         metavar='', type=str, default='General')
+    parser.add_argument('-v', '--video', help='path to the video file the annotated stream is saved to',
+                        metavar='', type=str, default=None)
+    parser.add_argument('-m', '--metrics', help='path the stage metrics are written to, as json or prometheus text',
+                        metavar='', type=str, default=None)
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import platform
+import tempfile
+import cv2
+import numpy as np
+from loguru import logger
+
+from model.inference import Predict
+from model.videoCapture import Stream, Frame, Presence, FaceTracker
+from model.utilities.classifier import Centroids, Registry
+from model.utilities.data import Data, Image
+from model.utilities.image import normalize_histogram
+from model.utilities.config import config
+
+# metrics where a higher value of the current run is a regression
+LATENCIES = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of the process in MB
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return usage / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def summarize(latencies, items, elapsed):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "calls": len(latencies),
+        "items": items,
+        "throughput": items / elapsed if elapsed else 0.0,
+        "mean_ms": float(np.mean(latencies)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def measure(function, inputs, items=lambda sample: 1, repeat=config.BENCHMARK_REPEAT, warmup=1):
+    """
+    time a stage on every input, after running it on the first `warmup` inputs untimed
+    :param function: stage called with a single input
+    :param inputs: list of inputs
+    :param items: returns the number of items of an input the throughput is counted in, e.g. faces
+    :param repeat: number of timed passes over the inputs
+    :param warmup: number of untimed calls
+    :return: dict of the throughput in items per second and latency percentiles per call
+    """
+    for sample in inputs[:warmup]:
+        function(sample)
+
+    latencies, count = [], 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for sample in inputs:
+            begin = time.perf_counter()
+            function(sample)
+            latencies.append(time.perf_counter() - begin)
+            count += items(sample)
+
+    return summarize(latencies, count, time.perf_counter() - start)
+
+
+def face_crops(detector, images, margin=0.4):
+    """
+    crop the faces found in the images, with a margin so they are detected again when pasted
+    :return: list of face images
+    """
+    crops = []
+    for image in images:
+        height, width = image.shape[:2]
+        for face in detector.get_all_faces(image):
+            dx, dy = int(face.width() * margin), int(face.height() * margin)
+            top, bottom = max(0, face.top() - dy), min(height, face.bottom() + dy)
+            left, right = max(0, face.left() - dx), min(width, face.right() + dx)
+            if bottom > top and right > left:
+                crops.append(image[top:bottom, left:right])
+    return crops
+
+
+def synthetic_frame(crops, faces, resolution=(720, 1280), step=0, seed=0):
+    """
+    paste `faces` face crops on a grid of a noise background
+    :param crops: face images
+    :param faces: number of faces in the frame
+    :param resolution: (height, width) of the frame
+    :param step: index of the frame in a video, moves the faces within their cells
+    :param seed: seed of the background noise
+    :return: BGR image
+    """
+    height, width = resolution
+    frame = np.random.RandomState(seed).randint(0, 64, size=(height, width, 3)).astype(np.uint8)
+
+    columns = int(np.ceil(np.sqrt(faces)))
+    rows = int(np.ceil(faces / columns))
+    cell = min(height // rows, width // columns)
+    side = int(cell * 0.8)
+    shift = int((cell - side) / 2 * (1 + np.sin(step / 10)))
+
+    for index in range(faces):
+        crop = crops[index % len(crops)]
+        factor = side / max(crop.shape[:2])
+        crop = cv2.resize(crop, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        row, column = divmod(index, columns)
+        top, left = row * cell + shift, column * cell + shift
+        frame[top:top + crop.shape[0], left:left + crop.shape[1]] = crop
+
+    return frame
+
+
+def synthetic_video(path, crops, faces, frames, resolution=(720, 1280), fps=25):
+    """
+    write a video of `frames` synthetic frames with moving faces
+    :return: path of the video
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (resolution[1], resolution[0]))
+    for step in range(frames):
+        writer.write(synthetic_frame(crops, faces, resolution, step=step))
+    writer.release()
+    return path
+
+
+def classifier_for(subject, encodings):
+    """
+    :return: tuple of (classifier, names) of the subject, or of centroids fitted
+             on the benchmark's own encodings if the subject is not trained
+    """
+    classifier, names = Registry()[subject]
+    if classifier is not None:
+        return classifier, names
+
+    logger.warning('subject {} is not trained, classifying with synthetic centroids'.format(subject))
+    labels = np.arange(len(encodings)) % 10
+    return Centroids().fit(encodings, labels), ['student-{}'.format(index) for index in range(10)]
+
+
+def stages(predictor, images, subject, threshold, repeat):
+    """
+    benchmark every stage of the recognition pipeline on the images,
+    the inputs of each stage are the outputs of the previous one
+    :return: dict of the results of each stage
+    """
+    detector, model = predictor.detector, predictor.model
+
+    boxes = [detector.get_all_faces(image) for image in images]
+    landmarks = [[detector.find_landmarks(image, box) for box in faces] for image, faces in zip(images, boxes)]
+    aligned = [[detector.align_face(96, image, box, points, detector.OUTER_EYES_AND_NOSE)
+                for box, points in zip(faces, marks)] for image, faces, marks in zip(images, boxes, landmarks)]
+    encodings = [model.encoder(faces=faces) for faces in aligned if faces]
+    if not encodings:
+        logger.warning('no faces found, only the detection stages are benchmarked')
+
+    samples = list(zip(images, boxes, landmarks, aligned))
+    faces = [sample for sample in samples if sample[1]]
+    count = lambda sample: len(sample[1])
+
+    results = {
+        "clahe": measure(normalize_histogram, images, repeat=repeat),
+        "hog_detection": measure(detector.get_all_faces, images, repeat=repeat),
+    }
+    if not encodings:
+        return results
+
+    classifier, names = classifier_for(subject, np.concatenate(encodings))
+    labels = [predictor.classify(classifier, names, encoding, threshold)[0] for encoding in encodings]
+
+    results["landmarks"] = measure(
+        lambda sample: [detector.find_landmarks(sample[0], box) for box in sample[1]], faces, count, repeat)
+    results["alignment"] = measure(
+        lambda sample: [detector.align_face(96, sample[0], box, points, detector.OUTER_EYES_AND_NOSE)
+                        for box, points in zip(sample[1], sample[2])], faces, count, repeat)
+    results["embedding"] = measure(
+        lambda sample: model.encoder(faces=sample[3]), faces, count, repeat)
+    results["classification"] = measure(
+        lambda encoding: predictor.classify(classifier, names, encoding, threshold), encodings, len, repeat)
+
+    frames = []
+    for index, (sample, frame_labels) in enumerate(zip(faces, labels)):
+        frame = Frame(image=sample[0], timestamp=index * 40.0, index=index)
+        frame.labels = np.asarray(frame_labels, dtype=object)
+        frame.trust_vector = np.full(len(frame_labels), 100.0, dtype=np.float32)
+        frames.append(frame)
+
+    presence = Presence()
+    results["tracking"] = measure(presence.update, frames, lambda frame: len(frame.labels), repeat)
+
+    tracker = FaceTracker()
+    tracker.start(faces[0][0], labels[0], [100.0] * len(labels[0]), faces[0][1])
+    results["correlation_tracking"] = measure(
+        lambda sample: tracker.update(sample[0]), faces[:1], lambda sample: len(labels[0]), repeat)
+
+    return results
+
+
+def video(predictor, path, subject, threshold, repeat):
+    """
+    benchmark the whole headless video pipeline, the throughput is counted in frames. Every run
+    opens a new `Stream` so the presence state of a run does not carry over to the next one
+    """
+    probe = Stream(path, headless=True)
+    frames = len(probe)
+    probe.release()
+    return measure(lambda video: Stream(video, headless=True)(predictor, subject, threshold), [path],
+                   lambda video: frames, repeat=repeat, warmup=0)
+
+
+def run(arguments):
+    resolution = tuple(int(size) for size in arguments.resolution.split('x'))[::-1]
+    predictor = Predict()
+
+    images = [file() for file in Data.load(arguments.input, loaders=[Image]).get(Image.__name__)]
+    crops = face_crops(predictor.detector, images)
+    if not crops:
+        logger.error('no faces found in {}, synthetic inputs are skipped'.format(arguments.input))
+
+    results = {"test-data": stages(predictor, images, arguments.subject, arguments.threshold, arguments.repeat)}
+
+    for faces in arguments.faces if crops else []:
+        frames = [synthetic_frame(crops, faces, resolution, step=step, seed=step) for step in range(4)]
+        name = 'synthetic-{}-faces'.format(faces)
+        logger.info('benchmarking {}'.format(name))
+        results[name] = stages(predictor, frames, arguments.subject, arguments.threshold, arguments.repeat)
+
+    if crops and arguments.frames:
+        # the video is classified with the same classifier the synthetic frames were
+        aligned = [face for crop in crops for face in predictor.detector.align_all_faces(crop)]
+        predictor.registry = {arguments.subject: classifier_for(arguments.subject,
+                                                                predictor.model.encoder(faces=aligned))}
+        with tempfile.TemporaryDirectory() as directory:
+            for faces in arguments.faces:
+                path = synthetic_video(os.path.join(directory, 'video-{}.mp4'.format(faces)), crops, faces,
+                                       arguments.frames, resolution)
+                name = 'video-{}-faces'.format(faces)
+                logger.info('benchmarking {}'.format(name))
+                results[name] = {"pipeline": video(predictor, path, arguments.subject, arguments.threshold,
+                                                   arguments.video_repeat)}
+
+    return {
+        "timestamp": time.strftime(config.DATE_FORMAT),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "config": {
+            "NUM_THREADS": config.NUM_THREADS,
+            "QUANTIZATION": config.QUANTIZATION,
+            "DETECTION_SCALE": config.DETECTION_SCALE,
+            "DETECTION_UPSAMPLE": config.DETECTION_UPSAMPLE,
+            "BATCH_SIZE": config.BATCH_SIZE,
+        },
+        "results": results,
+        # the peak is of the whole process, so it is reported once for the run and not per stage
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def compare(baseline, current, tolerance=config.BENCHMARK_TOLERANCE):
+    """
+    compare two benchmark reports stage by stage
+    :param baseline: report of the reference run
+    :param current: report of the new run
+    :param tolerance: relative change tolerated before a stage is flagged
+    :return: list of the regressions
+    """
+    regressions = []
+    for inputs, results in current["results"].items():
+        for stage, metrics in results.items():
+            reference = baseline["results"].get(inputs, {}).get(stage)
+            if reference is None:
+                continue
+
+            checks = [(metric, metrics[metric] > reference[metric] * (1 + tolerance)) for metric in LATENCIES]
+            checks.append(("throughput", metrics["throughput"] < reference["throughput"] * (1 - tolerance)))
+            for metric, regressed in checks:
+                if regressed:
+                    regressions.append({
+                        "inputs": inputs, "stage": stage, "metric": metric,
+                        "baseline": reference[metric], "current": metrics[metric],
+                        "change": metrics[metric] / reference[metric] - 1 if reference[metric] else None,
+                    })
+
+    if "peak_rss_mb" in baseline and current["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append({
+            "inputs": "run", "stage": "process", "metric": "peak_rss_mb",
+            "baseline": baseline["peak_rss_mb"], "current": current["peak_rss_mb"],
+            "change": current["peak_rss_mb"] / baseline["peak_rss_mb"] - 1 if baseline["peak_rss_mb"] else None,
+        })
+
+    return regressions
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def main(arguments):
+    if arguments.compare:
+        baseline, current = map(load, arguments.compare)
+    else:
+        current = run(arguments)
+        os.makedirs(os.path.dirname(os.path.abspath(arguments.output)), exist_ok=True)
+        with open(arguments.output, 'w') as file:
+            json.dump(current, file, indent=2)
+        logger.info('benchmark results saved to {}'.format(arguments.output))
+        baseline = load(arguments.baseline) if arguments.baseline else None
+
+    if baseline is None:
+        return
+
+    regressions = compare(baseline, current, tolerance=arguments.tolerance)
+    print(json.dumps(regressions, indent=2))
+    if regressions:
+        logger.error('{} regressions found'.format(len(regressions)))
+        sys.exit(1)
+    logger.info('no regressions found')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the stages of the recognition pipeline')
+    parser.add_argument('-i', '--input', help='path to the folder of the benchmarked images',
+                        metavar='', type=str, default=os.path.join(config.BASE_DIR, 'test-data'))
+    parser.add_argument('-o', '--output', help='path of the json report',
+                        metavar='', type=str, default=os.path.join(config.OUTPUT, 'benchmark.json'))
+    parser.add_argument('-n', '--repeat', help='number of timed passes over the inputs of every stage',
+                        metavar='', type=int, default=config.BENCHMARK_REPEAT)
+    parser.add_argument('-f', '--faces', help='number of faces in the synthetic frames and videos',
+                        metavar='', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('-r', '--resolution', help='resolution of the synthetic frames and videos',
+                        metavar='', type=str, default='1280x720')
+    parser.add_argument('--frames', help='number of frames of the synthetic videos, 0 skips them',
+                        metavar='', type=int, default=50)
+    parser.add_argument('--video-repeat', help='number of timed runs of every synthetic video',
+                        metavar='', type=int, default=3)
+    parser.add_argument('-c', '--subject', help='subject whose classifier is benchmarked',
+                        metavar='', type=str, default='General')
+    parser.add_argument('-p', '--threshold', help='threshold value for recognizing the faces',
+                        metavar='', type=int, default=27)
+    parser.add_argument('-b', '--baseline', help='report of a previous run the results are compared to',
+                        metavar='', type=str, default=None)
+    parser.add_argument('-t', '--tolerance', help='relative slowdown reported as a regression',
+                        metavar='', type=float, default=config.BENCHMARK_TOLERANCE)
+    parser.add_argument('--compare', help='only compare two reports: BASELINE CURRENT',
+                        metavar='', type=str, nargs=2, default=None)
+
+    args = parser.parse_args()
+    main(args)
@@ -1,16 +1,16 @@
 # import required libraries
 import cv2
 from os import unlink
-import dlib
 import numpy as np
 import argparse
 from loguru import logger
 
 from model.utilities.utils import remove_files
-from model.utilities.image import save_image, draw_rectangles, normalize_histogram
+from model.utilities.image import save_image, draw_rectangles, normalize_histogram, overlap
 from model.utilities.data import Data, Image
 from model.utilities.defaults import MIN_MAX_TEMPLATE
 from model.utilities.config import config
+from model.utilities.runtime import configure_threads
 
 
 class FaceDetector:
@@ -28,34 +28,108 @@ class FaceDetector:
     INNER_EYES_AND_BOTTOM_LIP = [39, 42, 57]
     OUTER_EYES_AND_NOSE = [36, 45, 33]
 
-    def __init__(self, face_predictor):
+    def __init__(self, face_predictor, scale=config.DETECTION_SCALE, upsample=config.DETECTION_UPSAMPLE):
         """
         Instantiate an 'AlignDlib' object.
         :param face_predictor: The path to dlib's
         :type face_predictor: str
+        :param scale: Factor the image is resized by before detection.
+        :type scale: float
+        :param upsample: Number of times the image is upsampled by the detector.
+        :type upsample: int
         """
         assert face_predictor is not None
+        configure_threads()
 
+        import dlib
         self.detector = dlib.get_frontal_face_detector()
         self.predictor = dlib.shape_predictor(face_predictor)
+        self.scale = scale
+        self.upsample = upsample
 
-    def get_all_faces(self, image):
+    def get_all_faces(self, image, scale=None, upsample=None):
         """
         Find all face bounding boxes in an image.
+        Detection runs on a grayscale copy downscaled by `scale` and the boxes
+        are mapped back to the coordinates of the full resolution image.
         :param image: RGB image to process. Shape: (height, width, 3)
         :type image: numpy.ndarray
+        :param scale: Factor the image is resized by before detection. Defaults to the detector's.
+        :type scale: float
+        :param upsample: Number of times the image is upsampled. Defaults to the detector's.
+        :type upsample: int
         :return: All face bounding boxes in an image.
         :rtype: dlib.rectangles
         """
         assert image is not None
-        image = normalize_histogram(image)
+        scale = scale if scale else self.scale
+        upsample = upsample if upsample is not None else self.upsample
+
+        image = normalize_histogram(image, scale=scale)
         try:
-            return self.detector(image, 1)
+            faces = self.detector(image, upsample)
         except Exception as e:
             logger.warning("Warning: {}".format(e))
             # In rare cases, exceptions are thrown.
             return []
 
+        if scale == 1.0:
+            return faces
+
+        import dlib
+        return dlib.rectangles([self.rescale(face, 1.0 / scale) for face in faces])
+
+    def get_faces_around(self, image, regions, margin=config.ROI_MARGIN, upsample=None):
+        """
+        Find the face bounding boxes only within windows around the given regions,
+        e.g. the faces found in the previous frame of a video.
+        :param image: RGB image to process. Shape: (height, width, 3)
+        :type image: numpy.ndarray
+        :param regions: Bounding boxes to search around.
+        :type regions: list of dlib.rectangle
+        :param margin: Fraction of the box size each window is expanded by on every side.
+        :type margin: float
+        :param upsample: Number of times the windows are upsampled. Defaults to the detector's.
+        :type upsample: int
+        :return: The face bounding boxes found in the windows.
+        :rtype: dlib.rectangles
+        """
+        assert image is not None
+        import dlib
+
+        height, width = image.shape[:2]
+
+        faces = []
+        for region in regions:
+            dx, dy = int(region.width() * margin), int(region.height() * margin)
+            left, top = max(0, region.left() - dx), max(0, region.top() - dy)
+            right, bottom = min(width, region.right() + dx), min(height, region.bottom() + dy)
+            if right <= left or bottom <= top:
+                continue
+
+            for face in self.get_all_faces(image[top:bottom, left:right], scale=1.0, upsample=upsample):
+                face = dlib.rectangle(face.left() + left, face.top() + top, face.right() + left, face.bottom() + top)
+                # windows of nearby faces overlap, keep a face found twice only once
+                if all(overlap(face, other) < 0.5 for other in faces):
+                    faces.append(face)
+
+        return dlib.rectangles(faces)
+
+    @staticmethod
+    def rescale(bounding_box, factor):
+        """
+        Scale a bounding box by the given factor.
+        :param bounding_box: Bounding box to scale.
+        :type bounding_box: dlib.rectangle
+        :param factor: Scale factor.
+        :type factor: float
+        :return: The scaled bounding box.
+        :rtype: dlib.rectangle
+        """
+        import dlib
+        return dlib.rectangle(int(round(bounding_box.left() * factor)), int(round(bounding_box.top() * factor)),
+                              int(round(bounding_box.right() * factor)), int(round(bounding_box.bottom() * factor)))
+
     def get_face(self, image, skip_multi=False):
         """
         Find the largest face bounding box in an image.
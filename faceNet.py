@@ -1,39 +1,85 @@
-import tensorflow as tf
-from keras import backend as K
-from keras.layers import Conv2D, ZeroPadding2D, Input, concatenate
-from keras.layers.core import Dense, Activation, Lambda, Flatten
-from keras.layers.normalization import BatchNormalization
-from keras.layers.pooling import MaxPooling2D, AveragePooling2D
-from keras.models import Model
-
+import os
+import argparse
 import numpy as np
 from loguru import logger
 from model.utilities.config import config
+from model.utilities.utils import chunked, prefetch
+from model.utilities.runtime import configure_tensorflow
 from types import GeneratorType
 
 
 class FaceNet:
-    def __init__(self):
-        self.model = self.init_model()
-        self.model.load_weights(config.MODEL)
+    def __init__(self, frozen=True):
+        """
+        :param frozen: True to use the exported model selected in config if it exists,
+                       False to build the keras model, or the path to an exported model
+        """
+        configure_tensorflow()
+
+        path = self.artifact() if frozen is True else frozen
+        if path and os.path.exists(path):
+            logger.info('loading frozen model {}'.format(os.path.basename(path)))
+            self.model = FrozenModel.load(path)
+        else:
+            self.model = self.init_model()
+            self.model.load_weights(config.MODEL)
+
+    @staticmethod
+    def artifact(quantization=config.QUANTIZATION):
+        """
+        :param quantization: None, "float16" or "int8"
+        :return: path of the exported model
+        """
+        if quantization:
+            return config.QUANTIZED_MODEL.format(quantization)
+        return config.FROZEN_MODEL
 
     @staticmethod
-    def init_model():
+    def init_model(fused=False):
+        """
+        build the OpenFace nn4.small2 graph
+        :param fused: build the inference graph without batch normalization layers,
+                      which are folded into the convolutions, and with each L2 pooling as a single op
+        :return: keras Model
+        """
+        # tensorflow and keras are imported only once the model is built
+        import tensorflow as tf
+        from keras import backend as K
+        from keras.layers import Conv2D, ZeroPadding2D, Input, concatenate
+        from keras.layers.core import Dense, Activation, Lambda, Flatten
+        from keras.layers.normalization import BatchNormalization
+        from keras.layers.pooling import MaxPooling2D, AveragePooling2D
+        from keras.models import Model
+
+        def batch_norm(name):
+            if fused:
+                return lambda x: x
+            return BatchNormalization(axis=3, epsilon=0.00001, name=name)
+
+        def l2_pool(x, name):
+            if fused:
+                return Lambda(lambda x: tf.sqrt(tf.nn.avg_pool2d(tf.square(x), 3, 3, 'VALID') * 9),
+                              name='l2_pool_' + name)(x)
+            x = Lambda(lambda x: x ** 2, name='power2_' + name)(x)
+            x = AveragePooling2D(pool_size=(3, 3), strides=(3, 3))(x)
+            x = Lambda(lambda x: x * 9, name='mult9_' + name)(x)
+            return Lambda(lambda x: K.sqrt(x), name='sqrt_' + name)(x)
+
         my_input = Input(shape=(96, 96, 3))
 
         x = ZeroPadding2D(padding=(3, 3), input_shape=(96, 96, 3))(my_input)
         x = Conv2D(64, (7, 7), strides=(2, 2), name='conv1')(x)
-        x = BatchNormalization(axis=3, epsilon=0.00001, name='bn1')(x)
+        x = batch_norm(name='bn1')(x)
         x = Activation('relu')(x)
         x = ZeroPadding2D(padding=(1, 1))(x)
         x = MaxPooling2D(pool_size=3, strides=2)(x)
         x = Lambda(lambda x: tf.nn.lrn(x, alpha=1e-4, beta=0.75), name='lrn_1')(x)
         x = Conv2D(64, (1, 1), name='conv2')(x)
-        x = BatchNormalization(axis=3, epsilon=0.00001, name='bn2')(x)
+        x = batch_norm(name='bn2')(x)
         x = Activation('relu')(x)
         x = ZeroPadding2D(padding=(1, 1))(x)
         x = Conv2D(192, (3, 3), name='conv3')(x)
-        x = BatchNormalization(axis=3, epsilon=0.00001, name='bn3')(x)
+        x = batch_norm(name='bn3')(x)
         x = Activation('relu')(x)
         Lambda(lambda x: tf.nn.lrn(x, alpha=1e-4, beta=0.75), name='lrn_2')(x)
         x = ZeroPadding2D(padding=(1, 1))(x)
@@ -41,80 +87,77 @@ class FaceNet:
 
         # Inception3a
         inception_3a_3x3 = Conv2D(96, (1, 1), name='inception_3a_3x3_conv1')(x)
-        inception_3a_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3a_3x3_bn1')(inception_3a_3x3)
+        inception_3a_3x3 = batch_norm(name='inception_3a_3x3_bn1')(inception_3a_3x3)
         inception_3a_3x3 = Activation('relu')(inception_3a_3x3)
         inception_3a_3x3 = ZeroPadding2D(padding=(1, 1))(inception_3a_3x3)
         inception_3a_3x3 = Conv2D(128, (3, 3), name='inception_3a_3x3_conv2')(inception_3a_3x3)
-        inception_3a_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3a_3x3_bn2')(inception_3a_3x3)
+        inception_3a_3x3 = batch_norm(name='inception_3a_3x3_bn2')(inception_3a_3x3)
         inception_3a_3x3 = Activation('relu')(inception_3a_3x3)
 
         inception_3a_5x5 = Conv2D(16, (1, 1), name='inception_3a_5x5_conv1')(x)
-        inception_3a_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3a_5x5_bn1')(inception_3a_5x5)
+        inception_3a_5x5 = batch_norm(name='inception_3a_5x5_bn1')(inception_3a_5x5)
         inception_3a_5x5 = Activation('relu')(inception_3a_5x5)
         inception_3a_5x5 = ZeroPadding2D(padding=(2, 2))(inception_3a_5x5)
         inception_3a_5x5 = Conv2D(32, (5, 5), name='inception_3a_5x5_conv2')(inception_3a_5x5)
-        inception_3a_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3a_5x5_bn2')(inception_3a_5x5)
+        inception_3a_5x5 = batch_norm(name='inception_3a_5x5_bn2')(inception_3a_5x5)
         inception_3a_5x5 = Activation('relu')(inception_3a_5x5)
 
         inception_3a_pool = MaxPooling2D(pool_size=3, strides=2)(x)
         inception_3a_pool = Conv2D(32, (1, 1), name='inception_3a_pool_conv')(inception_3a_pool)
-        inception_3a_pool = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3a_pool_bn')(inception_3a_pool)
+        inception_3a_pool = batch_norm(name='inception_3a_pool_bn')(inception_3a_pool)
         inception_3a_pool = Activation('relu')(inception_3a_pool)
         inception_3a_pool = ZeroPadding2D(padding=((3, 4), (3, 4)))(inception_3a_pool)
 
         inception_3a_1x1 = Conv2D(64, (1, 1), name='inception_3a_1x1_conv')(x)
-        inception_3a_1x1 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3a_1x1_bn')(inception_3a_1x1)
+        inception_3a_1x1 = batch_norm(name='inception_3a_1x1_bn')(inception_3a_1x1)
         inception_3a_1x1 = Activation('relu')(inception_3a_1x1)
 
         inception_3a = concatenate([inception_3a_3x3, inception_3a_5x5, inception_3a_pool, inception_3a_1x1], axis=3)
 
         # Inception3b
         inception_3b_3x3 = Conv2D(96, (1, 1), name='inception_3b_3x3_conv1')(inception_3a)
-        inception_3b_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3b_3x3_bn1')(inception_3b_3x3)
+        inception_3b_3x3 = batch_norm(name='inception_3b_3x3_bn1')(inception_3b_3x3)
         inception_3b_3x3 = Activation('relu')(inception_3b_3x3)
         inception_3b_3x3 = ZeroPadding2D(padding=(1, 1))(inception_3b_3x3)
         inception_3b_3x3 = Conv2D(128, (3, 3), name='inception_3b_3x3_conv2')(inception_3b_3x3)
-        inception_3b_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3b_3x3_bn2')(inception_3b_3x3)
+        inception_3b_3x3 = batch_norm(name='inception_3b_3x3_bn2')(inception_3b_3x3)
         inception_3b_3x3 = Activation('relu')(inception_3b_3x3)
 
         inception_3b_5x5 = Conv2D(32, (1, 1), name='inception_3b_5x5_conv1')(inception_3a)
-        inception_3b_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3b_5x5_bn1')(inception_3b_5x5)
+        inception_3b_5x5 = batch_norm(name='inception_3b_5x5_bn1')(inception_3b_5x5)
         inception_3b_5x5 = Activation('relu')(inception_3b_5x5)
         inception_3b_5x5 = ZeroPadding2D(padding=(2, 2))(inception_3b_5x5)
         inception_3b_5x5 = Conv2D(64, (5, 5), name='inception_3b_5x5_conv2')(inception_3b_5x5)
-        inception_3b_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3b_5x5_bn2')(inception_3b_5x5)
+        inception_3b_5x5 = batch_norm(name='inception_3b_5x5_bn2')(inception_3b_5x5)
         inception_3b_5x5 = Activation('relu')(inception_3b_5x5)
 
-        inception_3b_pool = Lambda(lambda x: x ** 2, name='power2_3b')(inception_3a)
-        inception_3b_pool = AveragePooling2D(pool_size=(3, 3), strides=(3, 3))(inception_3b_pool)
-        inception_3b_pool = Lambda(lambda x: x * 9, name='mult9_3b')(inception_3b_pool)
-        inception_3b_pool = Lambda(lambda x: K.sqrt(x), name='sqrt_3b')(inception_3b_pool)
+        inception_3b_pool = l2_pool(inception_3a, name='3b')
         inception_3b_pool = Conv2D(64, (1, 1), name='inception_3b_pool_conv')(inception_3b_pool)
-        inception_3b_pool = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3b_pool_bn')(inception_3b_pool)
+        inception_3b_pool = batch_norm(name='inception_3b_pool_bn')(inception_3b_pool)
         inception_3b_pool = Activation('relu')(inception_3b_pool)
         inception_3b_pool = ZeroPadding2D(padding=(4, 4))(inception_3b_pool)
 
         inception_3b_1x1 = Conv2D(64, (1, 1), name='inception_3b_1x1_conv')(inception_3a)
-        inception_3b_1x1 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3b_1x1_bn')(inception_3b_1x1)
+        inception_3b_1x1 = batch_norm(name='inception_3b_1x1_bn')(inception_3b_1x1)
         inception_3b_1x1 = Activation('relu')(inception_3b_1x1)
 
         inception_3b = concatenate([inception_3b_3x3, inception_3b_5x5, inception_3b_pool, inception_3b_1x1], axis=3)
 
         # Inception3c
         inception_3c_3x3 = Conv2D(128, (1, 1), strides=(1, 1), name='inception_3c_3x3_conv1')(inception_3b)
-        inception_3c_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3c_3x3_bn1')(inception_3c_3x3)
+        inception_3c_3x3 = batch_norm(name='inception_3c_3x3_bn1')(inception_3c_3x3)
         inception_3c_3x3 = Activation('relu')(inception_3c_3x3)
         inception_3c_3x3 = ZeroPadding2D(padding=(1, 1))(inception_3c_3x3)
         inception_3c_3x3 = Conv2D(256, (3, 3), strides=(2, 2), name='inception_3c_3x3_conv' + '2')(inception_3c_3x3)
-        inception_3c_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3c_3x3_bn' + '2')(inception_3c_3x3)
+        inception_3c_3x3 = batch_norm(name='inception_3c_3x3_bn' + '2')(inception_3c_3x3)
         inception_3c_3x3 = Activation('relu')(inception_3c_3x3)
 
         inception_3c_5x5 = Conv2D(32, (1, 1), strides=(1, 1), name='inception_3c_5x5_conv1')(inception_3b)
-        inception_3c_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3c_5x5_bn1')(inception_3c_5x5)
+        inception_3c_5x5 = batch_norm(name='inception_3c_5x5_bn1')(inception_3c_5x5)
         inception_3c_5x5 = Activation('relu')(inception_3c_5x5)
         inception_3c_5x5 = ZeroPadding2D(padding=(2, 2))(inception_3c_5x5)
         inception_3c_5x5 = Conv2D(64, (5, 5), strides=(2, 2), name='inception_3c_5x5_conv' + '2')(inception_3c_5x5)
-        inception_3c_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_3c_5x5_bn' + '2')(inception_3c_5x5)
+        inception_3c_5x5 = batch_norm(name='inception_3c_5x5_bn' + '2')(inception_3c_5x5)
         inception_3c_5x5 = Activation('relu')(inception_3c_5x5)
 
         inception_3c_pool = MaxPooling2D(pool_size=3, strides=2)(inception_3b)
@@ -124,52 +167,49 @@ class FaceNet:
 
         # inception 4a
         inception_4a_3x3 = Conv2D(96, (1, 1), strides=(1, 1), name='inception_4a_3x3_conv' + '1')(inception_3c)
-        inception_4a_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4a_3x3_bn' + '1')(inception_4a_3x3)
+        inception_4a_3x3 = batch_norm(name='inception_4a_3x3_bn' + '1')(inception_4a_3x3)
         inception_4a_3x3 = Activation('relu')(inception_4a_3x3)
         inception_4a_3x3 = ZeroPadding2D(padding=(1, 1))(inception_4a_3x3)
         inception_4a_3x3 = Conv2D(192, (3, 3), strides=(1, 1), name='inception_4a_3x3_conv' + '2')(inception_4a_3x3)
-        inception_4a_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4a_3x3_bn' + '2')(inception_4a_3x3)
+        inception_4a_3x3 = batch_norm(name='inception_4a_3x3_bn' + '2')(inception_4a_3x3)
         inception_4a_3x3 = Activation('relu')(inception_4a_3x3)
 
         inception_4a_5x5 = Conv2D(32, (1, 1), strides=(1, 1), name='inception_4a_5x5_conv1')(inception_3c)
-        inception_4a_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4a_5x5_bn1')(inception_4a_5x5)
+        inception_4a_5x5 = batch_norm(name='inception_4a_5x5_bn1')(inception_4a_5x5)
         inception_4a_5x5 = Activation('relu')(inception_4a_5x5)
         inception_4a_5x5 = ZeroPadding2D(padding=(2, 2))(inception_4a_5x5)
         inception_4a_5x5 = Conv2D(64, (5, 5), strides=(1, 1), name='inception_4a_5x5_conv' + '2')(inception_4a_5x5)
-        inception_4a_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4a_5x5_bn' + '2')(inception_4a_5x5)
+        inception_4a_5x5 = batch_norm(name='inception_4a_5x5_bn' + '2')(inception_4a_5x5)
         inception_4a_5x5 = Activation('relu')(inception_4a_5x5)
 
-        inception_4a_pool = Lambda(lambda x: x ** 2, name='power2_4a')(inception_3c)
-        inception_4a_pool = AveragePooling2D(pool_size=(3, 3), strides=(3, 3))(inception_4a_pool)
-        inception_4a_pool = Lambda(lambda x: x * 9, name='mult9_4a')(inception_4a_pool)
-        inception_4a_pool = Lambda(lambda x: K.sqrt(x), name='sqrt_4a')(inception_4a_pool)
+        inception_4a_pool = l2_pool(inception_3c, name='4a')
 
         inception_4a_pool = Conv2D(128, (1, 1), strides=(1, 1), name='inception_4a_pool_conv' + '')(inception_4a_pool)
-        inception_4a_pool = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4a_pool_bn' + '')(inception_4a_pool)
+        inception_4a_pool = batch_norm(name='inception_4a_pool_bn' + '')(inception_4a_pool)
         inception_4a_pool = Activation('relu')(inception_4a_pool)
         inception_4a_pool = ZeroPadding2D(padding=(2, 2))(inception_4a_pool)
 
         inception_4a_1x1 = Conv2D(256, (1, 1), strides=(1, 1), name='inception_4a_1x1_conv' + '')(inception_3c)
-        inception_4a_1x1 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4a_1x1_bn' + '')(inception_4a_1x1)
+        inception_4a_1x1 = batch_norm(name='inception_4a_1x1_bn' + '')(inception_4a_1x1)
         inception_4a_1x1 = Activation('relu')(inception_4a_1x1)
 
         inception_4a = concatenate([inception_4a_3x3, inception_4a_5x5, inception_4a_pool, inception_4a_1x1], axis=3)
 
         # inception4e
         inception_4e_3x3 = Conv2D(160, (1, 1), strides=(1, 1), name='inception_4e_3x3_conv' + '1')(inception_4a)
-        inception_4e_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4e_3x3_bn' + '1')(inception_4e_3x3)
+        inception_4e_3x3 = batch_norm(name='inception_4e_3x3_bn' + '1')(inception_4e_3x3)
         inception_4e_3x3 = Activation('relu')(inception_4e_3x3)
         inception_4e_3x3 = ZeroPadding2D(padding=(1, 1))(inception_4e_3x3)
         inception_4e_3x3 = Conv2D(256, (3, 3), strides=(2, 2), name='inception_4e_3x3_conv' + '2')(inception_4e_3x3)
-        inception_4e_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4e_3x3_bn' + '2')(inception_4e_3x3)
+        inception_4e_3x3 = batch_norm(name='inception_4e_3x3_bn' + '2')(inception_4e_3x3)
         inception_4e_3x3 = Activation('relu')(inception_4e_3x3)
 
         inception_4e_5x5 = Conv2D(64, (1, 1), strides=(1, 1), name='inception_4e_5x5_conv' + '1')(inception_4a)
-        inception_4e_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4e_5x5_bn' + '1')(inception_4e_5x5)
+        inception_4e_5x5 = batch_norm(name='inception_4e_5x5_bn' + '1')(inception_4e_5x5)
         inception_4e_5x5 = Activation('relu')(inception_4e_5x5)
         inception_4e_5x5 = ZeroPadding2D(padding=(2, 2))(inception_4e_5x5)
         inception_4e_5x5 = Conv2D(128, (5, 5), strides=(2, 2), name='inception_4e_5x5_conv' + '2')(inception_4e_5x5)
-        inception_4e_5x5 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_4e_5x5_bn' + '2')(inception_4e_5x5)
+        inception_4e_5x5 = batch_norm(name='inception_4e_5x5_bn' + '2')(inception_4e_5x5)
         inception_4e_5x5 = Activation('relu')(inception_4e_5x5)
 
         inception_4e_pool = MaxPooling2D(pool_size=3, strides=2)(inception_4a)
@@ -179,48 +219,45 @@ class FaceNet:
 
         # inception5a
         inception_5a_3x3 = Conv2D(96, (1, 1), strides=(1, 1), name='inception_5a_3x3_conv' + '1')(inception_4e)
-        inception_5a_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5a_3x3_bn' + '1')(inception_5a_3x3)
+        inception_5a_3x3 = batch_norm(name='inception_5a_3x3_bn' + '1')(inception_5a_3x3)
         inception_5a_3x3 = Activation('relu')(inception_5a_3x3)
         inception_5a_3x3 = ZeroPadding2D(padding=(1, 1))(inception_5a_3x3)
         inception_5a_3x3 = Conv2D(384, (3, 3), strides=(1, 1), name='inception_5a_3x3_conv' + '2')(inception_5a_3x3)
-        inception_5a_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5a_3x3_bn' + '2')(inception_5a_3x3)
+        inception_5a_3x3 = batch_norm(name='inception_5a_3x3_bn' + '2')(inception_5a_3x3)
         inception_5a_3x3 = Activation('relu')(inception_5a_3x3)
 
-        inception_5a_pool = Lambda(lambda x: x ** 2, name='power2_5a')(inception_4e)
-        inception_5a_pool = AveragePooling2D(pool_size=(3, 3), strides=(3, 3))(inception_5a_pool)
-        inception_5a_pool = Lambda(lambda x: x * 9, name='mult9_5a')(inception_5a_pool)
-        inception_5a_pool = Lambda(lambda x: K.sqrt(x), name='sqrt_5a')(inception_5a_pool)
+        inception_5a_pool = l2_pool(inception_4e, name='5a')
 
         inception_5a_pool = Conv2D(96, (1, 1), strides=(1, 1), name='inception_5a_pool_conv' + '')(inception_5a_pool)
-        inception_5a_pool = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5a_pool_bn' + '')(inception_5a_pool)
+        inception_5a_pool = batch_norm(name='inception_5a_pool_bn' + '')(inception_5a_pool)
         inception_5a_pool = Activation('relu')(inception_5a_pool)
         inception_5a_pool = ZeroPadding2D(padding=(1, 1))(inception_5a_pool)
 
         inception_5a_1x1 = Conv2D(256, (1, 1), strides=(1, 1), name='inception_5a_1x1_conv' + '')(inception_4e)
-        inception_5a_1x1 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5a_1x1_bn' + '')(inception_5a_1x1)
+        inception_5a_1x1 = batch_norm(name='inception_5a_1x1_bn' + '')(inception_5a_1x1)
         inception_5a_1x1 = Activation('relu')(inception_5a_1x1)
 
         inception_5a = concatenate([inception_5a_3x3, inception_5a_pool, inception_5a_1x1], axis=3)
 
         # inception_5b
         inception_5b_3x3 = Conv2D(96, (1, 1), strides=(1, 1), name='inception_5b_3x3_conv' + '1')(inception_5a)
-        inception_5b_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5b_3x3_bn' + '1')(inception_5b_3x3)
+        inception_5b_3x3 = batch_norm(name='inception_5b_3x3_bn' + '1')(inception_5b_3x3)
         inception_5b_3x3 = Activation('relu')(inception_5b_3x3)
         inception_5b_3x3 = ZeroPadding2D(padding=(1, 1))(inception_5b_3x3)
         inception_5b_3x3 = Conv2D(384, (3, 3), strides=(1, 1), name='inception_5b_3x3_conv' + '2')(inception_5b_3x3)
-        inception_5b_3x3 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5b_3x3_bn' + '2')(inception_5b_3x3)
+        inception_5b_3x3 = batch_norm(name='inception_5b_3x3_bn' + '2')(inception_5b_3x3)
         inception_5b_3x3 = Activation('relu')(inception_5b_3x3)
 
         inception_5b_pool = MaxPooling2D(pool_size=3, strides=2)(inception_5a)
 
         inception_5b_pool = Conv2D(96, (1, 1), strides=(1, 1), name='inception_5b_pool_conv' + '')(inception_5b_pool)
-        inception_5b_pool = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5b_pool_bn' + '')(inception_5b_pool)
+        inception_5b_pool = batch_norm(name='inception_5b_pool_bn' + '')(inception_5b_pool)
         inception_5b_pool = Activation('relu')(inception_5b_pool)
 
         inception_5b_pool = ZeroPadding2D(padding=(1, 1))(inception_5b_pool)
 
         inception_5b_1x1 = Conv2D(256, (1, 1), strides=(1, 1), name='inception_5b_1x1_conv' + '')(inception_5a)
-        inception_5b_1x1 = BatchNormalization(axis=3, epsilon=0.00001, name='inception_5b_1x1_bn' + '')(inception_5b_1x1)
+        inception_5b_1x1 = batch_norm(name='inception_5b_1x1_bn' + '')(inception_5b_1x1)
         inception_5b_1x1 = Activation('relu')(inception_5b_1x1)
 
         inception_5b = concatenate([inception_5b_3x3, inception_5b_pool, inception_5b_1x1], axis=3)
@@ -234,18 +271,159 @@ class FaceNet:
 
         return model
 
-    def encoder(self, faces):
+    @classmethod
+    def export(cls, path=config.FROZEN_MODEL, weights=config.MODEL, quantization=None, calibration=None):
+        """
+        export the model as a frozen inference graph, batch normalization is folded
+        into the preceding convolutions and the L2 pooling ops are fused
+        :param path: path of the exported model, a `.tflite` file or a SavedModel directory
+        :param weights: path to the pre-trained model weights
+        :param quantization: None, "float16" weights or "int8" weights and activations, tflite only
+        :param calibration: aligned faces the int8 activation ranges are calibrated on
+        :return: path of the exported model
+        """
+        import tensorflow as tf
+
+        assert quantization in (None, "float16", "int8"), "quantization should be None, float16 or int8"
+        assert not quantization or path.endswith('.tflite'), "only tflite models can be quantized"
+        assert quantization != "int8" or calibration is not None, "int8 quantization requires calibration faces"
+
+        model = cls.init_model()
+        model.load_weights(weights)
+        fused = cls.init_model(fused=True)
+
+        for layer in fused.layers:
+            if not layer.weights:
+                continue
+
+            source = model.get_layer(layer.name)
+            if layer.name == 'dense_layer':
+                layer.set_weights(source.get_weights())
+                continue
+
+            # fold the batch normalization of the convolution into its kernel and bias
+            gamma, beta, mean, variance = model.get_layer('bn'.join(layer.name.rsplit('conv', 1))).get_weights()
+            kernel, bias = source.get_weights()
+            scale = gamma / np.sqrt(variance + 0.00001)
+            layer.set_weights([kernel * scale, (bias - mean) * scale + beta])
+
+        signature = tf.TensorSpec([None, 96, 96, 3], tf.float32, name='input')
+        function = tf.function(lambda x: fused(x, training=False), input_signature=[signature])
+
+        if path.endswith('.tflite'):
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([function.get_concrete_function()])
+            if quantization:
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantization == "float16":
+                converter.target_spec.supported_types = [tf.float16]
+            if quantization == "int8":
+                tensor = cls.to_tensor(calibration)
+                converter.representative_dataset = lambda: ([face[np.newaxis]] for face in tensor)
+
+            with open(path, 'wb') as file:
+                file.write(converter.convert())
+        else:
+            module = tf.Module()
+            module.fused = fused
+            module.serve = function
+            tf.saved_model.save(module, path, signatures=function.get_concrete_function())
+
+        logger.info('frozen model exported to {}'.format(path))
+        return path
+
+    @staticmethod
+    def to_tensor(faces):
+        """
+        stack the aligned faces into one contiguous float32 tensor
+        and scale the RGB values to the interval [0, 1]
+        :param faces: list of aligned faces. Shape: (96, 96, 3)
+        :return: numpy.ndarray of shape (n, 96, 96, 3)
+        """
+        tensor = np.ascontiguousarray(np.stack(faces), dtype=np.float32)
+        tensor *= 1. / 255.
+        return tensor
+
+    def encoder(self, faces, batch_size=config.BATCH_SIZE):
         if isinstance(faces, GeneratorType):
             faces = list(faces)
 
-        encodings_vector = np.zeros((len(faces), 128))
-        # train our face recognizer of our trained-data faces
-        for count, face in enumerate(faces):
-            image = face
-            # scale RGB values to interval [0,1]
-            image = (image / 255.).astype(np.float32)
-            # obtain embedding vector for image
-            encodings_vector[count] = self.model.predict(np.expand_dims(image, axis=0))[0]
-
-        return encodings_vector
-
+        if len(faces) == 0:
+            return np.zeros((0, 128), dtype=np.float32)
+
+        # obtain embedding vectors for all the faces in batches of `batch_size`
+        return self.model.predict(self.to_tensor(faces), batch_size=batch_size)
+
+    def stream_encoder(self, faces, chunk_size=config.BATCH_SIZE, overlap=True, pairs=False):
+        """
+        encode the faces chunk by chunk without materialising the whole iterable
+        :param faces: iterable or generator of aligned faces e.g. `Entity.faces`,
+                      or of (item, face) tuples e.g. `Entity.aligned` if `pairs` is set
+        :param chunk_size: number of faces encoded at a time
+        :param overlap: produce the next chunk on a background thread while the current one is encoded
+        :param pairs: carry the item of each face along with its embedding
+        :return: generator yielding numpy.ndarray of shape (<= chunk_size, 128),
+                 or tuples of (list of items, embeddings) if `pairs` is set
+        """
+        chunks = chunked(faces, chunk_size)
+        if overlap:
+            chunks = prefetch(chunks)
+
+        for chunk in chunks:
+            if not pairs:
+                yield self.encoder(faces=chunk, batch_size=chunk_size)
+                continue
+
+            items, chunk = zip(*chunk)
+            yield list(items), self.encoder(faces=list(chunk), batch_size=chunk_size)
+
+
+class FrozenModel:
+    """
+    Exported inference graph of FaceNet, loaded without rebuilding the keras model.
+    Follows the `predict` interface of the keras model.
+    """
+
+    def __init__(self, function=None, interpreter=None, loaded=None):
+        self.function = function
+        self.interpreter = interpreter
+        # the loaded SavedModel has to outlive its signature function
+        self.loaded = loaded
+
+    @classmethod
+    def load(cls, path):
+        import tensorflow as tf
+
+        if path.endswith('.tflite'):
+            interpreter = tf.lite.Interpreter(model_path=path)
+            interpreter.allocate_tensors()
+            return cls(interpreter=interpreter)
+
+        loaded = tf.saved_model.load(path)
+        return cls(function=loaded.signatures['serving_default'], loaded=loaded)
+
+    def predict(self, tensor, batch_size=config.BATCH_SIZE):
+        outputs = [self.infer(tensor[start:start + batch_size]) for start in range(0, len(tensor), batch_size)]
+        return np.concatenate(outputs) if outputs else np.zeros((0, 128), dtype=np.float32)
+
+    def infer(self, batch):
+        if self.function is not None:
+            return next(iter(self.function(input=batch).values())).numpy()
+
+        inputs, outputs = self.interpreter.get_input_details()[0], self.interpreter.get_output_details()[0]
+        if tuple(inputs['shape']) != batch.shape:
+            self.interpreter.resize_tensor_input(inputs['index'], batch.shape)
+            self.interpreter.allocate_tensors()
+        self.interpreter.set_tensor(inputs['index'], batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(outputs['index'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export FaceNet as a frozen inference graph')
+    parser.add_argument('-o', '--output', help='path to the exported model, a .tflite file or a directory',
+                        metavar='', type=str, default=config.FROZEN_MODEL)
+    parser.add_argument('-w', '--weights', help='path to the pre-trained model weights',
+                        metavar='', type=str, default=config.MODEL)
+
+    args = parser.parse_args()
+    FaceNet.export(path=args.output, weights=args.weights)
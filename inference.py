@@ -6,10 +6,11 @@ import os
 
 from model.faceNet import FaceNet
 from model.detect import FaceDetector
-from model.utilities.utils import remove_files, load_attendance
-from model.utilities.image import save_image, draw_rectangles, draw_text
+from model.utilities.utils import remove_files
+from model.utilities.image import AsyncImageWriter, draw_rectangles, draw_text, rect_to_bounding_box
 from model.utilities.data import Data, Image
-from model.utilities.classifier import Classifier
+from model.utilities.classifier import Registry
+from model.utilities.metrics import metrics
 from model.utilities.config import config
 
 
@@ -20,9 +21,11 @@ class Predict:
     def __init__(self):
         self.detector = FaceDetector(config.DETECTOR)
         self.model = FaceNet()
+        self.registry = Registry()
 
-    def __call__(self, image, subject, threshold, bounding_boxes=None, faces=None):
-        encodings, bounding_boxes = self.predict(image=image, bounding_boxes=bounding_boxes, faces=faces)
+    def __call__(self, image, subject, threshold, bounding_boxes=None, faces=None, scale=None, upsample=None):
+        encodings, bounding_boxes = self.predict(image=image, bounding_boxes=bounding_boxes, faces=faces,
+                                                 scale=scale, upsample=upsample)
         labels, trust_vector = self.recognize(subject=subject, threshold=threshold, encodings=encodings)
         return self.remove_duplicates(labels, trust_vector, bounding_boxes)
 
@@ -35,52 +38,61 @@ class Predict:
         if encodings is None and image is not None:
             encodings, bounding_boxes = self.predict(image=image)
 
-        logger.info('recognizing the detected faces in image')
+        classifier, names = self.registry[subject]
+        return self.classify(classifier, names, encodings, threshold)
 
-        classifier = Classifier.load(os.path.join(config.TRAINED_DATA), subject)
-        _, names = load_attendance(subject=subject)
-
-        labels, trust_vector = [], []
-        for encoding in encodings:
-            # recognize the person using the pretrained classifier
-            # reshape the encoding vector w.r.t classifier's input
-            encoding = encoding.reshape(1, 128)
-            label = classifier.predict(encoding)
-
-            # predicting the probability of recognition
-            vector = classifier.predict_proba(encoding)[0]  # get the probability vector
-            index = np.argmax(vector)  # get index of highest probability in the vector
-            probability = vector[index] * 100
+    @staticmethod
+    def classify(classifier, names, encodings, threshold):
+        if len(encodings) == 0:
+            return [], []
+
+        with metrics.timer("classify"):
+            # reshape the encodings w.r.t classifier's input
+            encodings = np.asarray(encodings).reshape(-1, 128)
+
+            if hasattr(classifier, "identify"):
+                # nearest neighbour lookup of all the faces in the embedding index
+                classes, trust_vector = classifier.identify(encodings)
+            else:
+                # predict the probability vectors of all the faces in a single call
+                probabilities = classifier.predict_proba(encodings)
+
+                # get index of highest probability in each vector
+                indices = np.argmax(probabilities, axis=1)
+                trust_vector = probabilities[np.arange(len(indices)), indices] * 100
+                classes = classifier.classes_[indices]
 
             # recognition is correct if the probability is above a certain threshold
-            label = names[label[0]] if probability > threshold else 'unknown'
-            labels.append(label)
-            trust_vector.append(probability)
+            names = np.asarray(names, dtype=object)
+            labels = np.where(trust_vector > threshold, names[classes], 'unknown')
 
-            logger.info('{}\'s face detected in image'.format(label))
+        labels, trust_vector = labels.tolist(), trust_vector.tolist()
+        metrics.increment("unknown_faces", labels.count('unknown'))
 
         return labels, trust_vector
 
-    def predict(self, image, bounding_boxes=None, faces=None):
+    def predict(self, image, bounding_boxes=None, faces=None, scale=None, upsample=None):
         # ------STEP-1--------
         # detect face from the image
         if bounding_boxes is None and faces is None:
-            bounding_boxes = self.detector.get_all_faces(image=image)
+            with metrics.timer("detect"):
+                bounding_boxes = self.detector.get_all_faces(image=image, scale=scale, upsample=upsample)
 
         # ------STEP-2--------
         # align each of the detected face
         if faces is None:
-            faces = self.detector.align_all_faces(image, bounding_boxes=bounding_boxes)
+            with metrics.timer("align"):
+                faces = self.detector.align_all_faces(image, bounding_boxes=bounding_boxes)
+        metrics.increment("faces", len(faces))
 
         # ------STEP-3--------
         # create a feature vector
         # to store the 128 embeddings of the n faces detected in the image
-        logger.info('creating feature vector for the detected faces')
 
         # ------STEP-4--------
         # encode each detected face into 128 features
-        logger.info('encoding detected faces')
-        encodings = self.model.encoder(faces=faces)
+        with metrics.timer("encode"):
+            encodings = self.model.encoder(faces=faces)
 
         return encodings, bounding_boxes
 
@@ -114,8 +126,14 @@ class Predict:
 
 def main(arguments):
     subject, is_subject = Data.verbose_name(arguments.subject)
+    metrics.enabled = metrics.enabled or arguments.metrics is not None
 
-    remove_files(arguments.output)
+    # annotated images are only drawn and saved if not running headless
+    sink = None
+    headless = arguments.headless or config.HEADLESS
+    if not headless:
+        remove_files(arguments.output)
+        sink = AsyncImageWriter(arguments.output, quality=arguments.quality)
 
     data = Data.load(arguments.input, loaders=[Image]).get(Image.__name__)
 
@@ -125,13 +143,26 @@ def main(arguments):
         logger.warning('======================================================================')
         image = file()
         labels, trust_vector, faces = predictor(image=image, subject=subject, threshold=arguments.threshold)
+        logger.info({"file": str(file), "detections": [
+            {"label": label, "probability": probability, "box": rect_to_bounding_box(face)}
+            for label, face, probability in zip(labels, faces, trust_vector)]})
+
+        if sink is None:
+            continue
+
         for label, face, probability in zip(labels, faces, trust_vector):
 
             draw_rectangles(image, [face])
             draw_text(image, f"{label} - {probability}", face)
 
         logger.info('saving image {}'.format(file))
-        save_image(image, 'output-{}'.format(file), arguments.output)
+        sink.write(image, 'output-{}'.format(file))
+
+    if sink is not None:
+        sink.close()
+
+    if arguments.metrics:
+        metrics.dump(arguments.metrics)
 
 
 if __name__ == '__main__':
@@ -146,6 +177,12 @@ if __name__ == '__main__':
                         metavar='', type=str, default='General')
     parser.add_argument('-p', '--threshold', help='threshold value for recognizing the faces',
                         metavar='', type=int, default=27)
+    parser.add_argument('-q', '--quality', help='JPEG quality of the saved images',
+                        metavar='', type=int, default=config.OUTPUT_QUALITY)
+    parser.add_argument('--headless', help='only log the detections without drawing or saving images',
+                        action='store_true')
+    parser.add_argument('-m', '--metrics', help='path the stage metrics are written to, as json or prometheus text',
+                        metavar='', type=str, default=None)
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,240 @@
+import threading
+import traceback
+import multiprocessing as mp
+from queue import Empty, Full
+from collections import deque
+from loguru import logger
+
+from model.detect import FaceDetector
+from model.faceNet import FaceNet
+from model.inference import Predict
+from model.utilities.classifier import Registry
+from model.utilities.metrics import metrics
+from model.utilities.runtime import configure_threads
+from model.utilities.config import config
+
+
+def to_boxes(rectangles):
+    # dlib rectangles are converted to tuples to be sent between processes
+    return [(box.left(), box.top(), box.right(), box.bottom()) for box in rectangles]
+
+
+def to_rectangles(boxes):
+    import dlib
+    return [dlib.rectangle(*box) for box in boxes]
+
+
+def run_worker(target, worker, workers, errors, results, enabled, *args):
+    """
+    run a stage in a worker process, a failure is sent to the parent on the errors queue
+    since the stages after it would otherwise wait forever for their sentinels. With metrics
+    enabled the worker's snapshot is sent to the parent on the results queue once it is done
+    """
+    # the spawned process imports the registry disabled unless enabled in config
+    metrics.enabled = enabled
+    try:
+        # pin the worker to its own cores before it loads its models
+        configure_threads(worker=worker, workers=workers)
+        target(*args)
+    except Exception:
+        errors.put((target.__name__, traceback.format_exc()))
+        raise
+
+    if enabled:
+        results.put(metrics.snapshot())
+
+
+def detect_worker(inputs, outputs, scale=None, upsample=None):
+    detector = FaceDetector(config.DETECTOR)
+    for item in iter(inputs.get, None):
+        index, image = item
+        with metrics.timer("detect"):
+            bounding_boxes = detector.get_all_faces(image=image, scale=scale, upsample=upsample)
+        with metrics.timer("align"):
+            faces = detector.align_all_faces(image, bounding_boxes=bounding_boxes)
+        metrics.increment("faces", len(faces))
+        outputs.put((index, to_boxes(bounding_boxes), faces))
+
+
+def encode_worker(inputs, outputs):
+    model = FaceNet()
+    for item in iter(inputs.get, None):
+        index, boxes, faces = item
+        with metrics.timer("encode"):
+            encodings = model.encoder(faces=faces)
+        outputs.put((index, boxes, encodings))
+
+
+def classify_worker(inputs, outputs, subject, threshold):
+    registry = Registry()
+    for item in iter(inputs.get, None):
+        index, boxes, encodings = item
+        classifier, names = registry[subject]
+        if classifier is None:
+            raise ValueError('no trained classifier for subject {}'.format(subject))
+        labels, trust_vector = Predict.classify(classifier, names, encodings, threshold)
+        outputs.put((index, Predict.remove_duplicates(labels, trust_vector, boxes)))
+    outputs.put(None)
+
+
+class Pipeline:
+    """
+    Runs the recognition of a video as separate worker processes for detection and alignment,
+    encoding and classification, connected by bounded queues. Frames are decoded in the calling
+    process and the results are tracked in their original order.
+    """
+
+    STAGES = ("detect", "encode", "classify")
+
+    # seconds between the checks of the workers while waiting on a queue
+    POLL = 1.0
+
+    def __init__(self, subject, threshold, workers=None, size=config.PIPELINE_QUEUE):
+        self.subject = subject
+        self.threshold = threshold
+        self.workers = dict(config.PIPELINE_WORKERS, **(workers if workers else {}))
+        self.size = size
+        # tensorflow and dlib are not fork safe once initialized
+        self.context = mp.get_context("spawn")
+
+    def __call__(self, stream):
+        queues = [self.context.Queue(maxsize=self.size) for _ in range(len(self.STAGES) + 1)]
+        errors = self.context.Queue()
+        targets = (detect_worker, encode_worker, classify_worker)
+        workers = sum(max(1, self.workers[stage]) for stage in self.STAGES)
+        # the spawned workers inherit the thread limits exported by the parent
+        configure_threads()
+
+        processes, worker = [], 0
+        for stage, target, inputs, outputs in zip(self.STAGES, targets, queues, queues[1:]):
+            args = {
+                "detect": (inputs, outputs, stream.scale, stream.upsample),
+                "encode": (inputs, outputs),
+                "classify": (inputs, outputs, self.subject, self.threshold),
+            }[stage]
+            processes.append([])
+            for _ in range(max(1, self.workers[stage])):
+                processes[-1].append(self.context.Process(target=run_worker, args=(target, worker, workers, errors, queues[-1], metrics.enabled) + args,
+                                                          daemon=True))
+                worker += 1
+
+        for stage in processes:
+            for process in stage:
+                process.start()
+
+        # frames sent through the pipeline, in the order they were decoded
+        pending, order, stop = {}, deque(), threading.Event()
+        feeder = threading.Thread(target=self.feed, args=(stream, queues, processes, pending, order, errors, stop),
+                                  daemon=True)
+        feeder.start()
+
+        results, done, completed = queues[-1], 0, {}
+        # the classify workers send their snapshot after their sentinel
+        snapshots = workers if metrics.enabled else 0
+        try:
+            while done < len(processes[-1]) or snapshots:
+                try:
+                    item = results.get(timeout=self.POLL)
+                except Empty:
+                    self.check(processes, errors)
+                    continue
+
+                if item is None:
+                    done += 1
+                    continue
+
+                if isinstance(item, dict):
+                    # metrics of a worker process
+                    metrics.merge(item)
+                    snapshots -= 1
+                    continue
+
+                index, result = item
+                completed[index] = result
+
+                # track the frames in the order they were decoded
+                while order and order[0] in completed:
+                    index = order.popleft()
+                    labels, trust_vector, boxes = completed.pop(index)
+                    pending.pop(index).track(labels, trust_vector, to_rectangles(boxes), annotate=False)
+        except BaseException:
+            # unblock the feeder and stop the workers still waiting on their queues
+            stop.set()
+            for stage in processes:
+                for process in stage:
+                    if process.is_alive():
+                        process.terminate()
+            raise
+        finally:
+            feeder.join()
+
+        return stream.entities
+
+    def check(self, processes, errors):
+        """
+        raise the error of a failed worker or of the feeder
+        """
+        try:
+            stage, trace = errors.get_nowait()
+        except Empty:
+            pass
+        else:
+            raise RuntimeError('pipeline stage {} failed:\n{}'.format(stage, trace))
+
+        for stage, workers in zip(self.STAGES, processes):
+            for process in workers:
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError('pipeline {} worker exited with code {}'.format(stage, process.exitcode))
+
+    def put(self, queue, item, stop):
+        """
+        put an item on a bounded queue unless the pipeline is stopped while waiting
+        :return: True if the item was put
+        """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=self.POLL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def feed(self, stream, queues, processes, pending, order, errors, stop):
+        try:
+            for count, frame in stream:
+                if not stream.scheduled(frame):
+                    continue
+                pending[count] = frame
+                order.append(count)
+                if not self.put(queues[0], (count, frame.image), stop):
+                    stream.release()
+                    return
+                self.gauge(queues, pending)
+
+            # shut down the stages one after the other once their inputs are exhausted
+            for stage, inputs in zip(processes, queues):
+                for _ in stage:
+                    if not self.put(inputs, None, stop):
+                        return
+                for process in stage:
+                    process.join()
+        except Exception:
+            errors.put(("feed", traceback.format_exc()))
+            return
+
+        logger.info('pipeline processed {} frames'.format(stream.number_of_frames))
+
+    def gauge(self, queues, pending):
+        """
+        record the depth of the input queue of every stage and the frames awaiting their results,
+        the stage timers are kept in the registries of the worker processes
+        """
+        if not metrics.enabled:
+            return
+        metrics.gauge("pending_frames", len(pending))
+        for stage, queue in zip(self.STAGES, queues):
+            try:
+                metrics.gauge("{}_queue".format(stage), queue.qsize())
+            except NotImplementedError:
+                # qsize is not available on macOS
+                return
@@ -5,6 +5,7 @@ import argparse
 from model.detect import FaceDetector
 from model.utilities.data import Data
 from model.faceNet import FaceNet
+from model.utilities.cache import EmbeddingCache
 from model.utilities.config import config
 
 from numpy import array
@@ -12,10 +13,11 @@ from pandas import DataFrame
 
 
 class Preprocessor:
-    def __init__(self, path):
+    def __init__(self, path, cache=config.CACHE_EMBEDDINGS):
         self.detector = FaceDetector(config.DETECTOR)
         self.model = FaceNet()
         self.path = path
+        self.cache = EmbeddingCache.load() if cache else None
         self.data = []
 
     def preprocess(self, path=None):
@@ -27,9 +29,16 @@ class Preprocessor:
         path = path if path else self.path
         data = Data.load(path=path).get(Data.__name__)
         for subject in data:
-            subject.preprocess(model=self.model, detector=self.detector)
+            subject.preprocess(model=self.model, detector=self.detector, cache=self.cache)
             self.data.append(subject)
 
+            if self.cache is not None:
+                self.cache.save()
+
+        # the cache is shared by all the subjects, it is only pruned after all of them were processed
+        if self.cache is not None and os.path.abspath(path) == os.path.abspath(config.TRAINING_DATA):
+            self.cache.save(prune=True)
+
         return self.data
 
     @staticmethod
@@ -0,0 +1,127 @@
+import sys
+import argparse
+import numpy as np
+from loguru import logger
+
+from model.detect import FaceDetector
+from model.faceNet import FaceNet
+from model.inference import Predict
+from model.utilities.classifier import Registry
+from model.utilities.data import Data
+from model.utilities.config import config
+
+
+def calibration_faces(path=config.TRAINING_DATA, samples=config.CALIBRATION_SAMPLES):
+    """
+    align the faces of the training images, images without a face are skipped
+    :param path: path to the training data
+    :param samples: maximum number of faces
+    :return: tuple of (list of aligned faces, list of the names of the students)
+    """
+    detector = FaceDetector(config.DETECTOR)
+    faces, names = [], []
+    for subject in Data.load(path=path).get(Data.__name__):
+        for entity in subject.entities:
+            for image in entity.images:
+                face = detector.align_face(image_dimensions=96, image=image(),
+                                           landmark_indices=detector.OUTER_EYES_AND_NOSE)
+                if face is None:
+                    continue
+                faces.append(face)
+                names.append(entity.name)
+                if len(faces) >= samples:
+                    return faces, names
+    return faces, names
+
+
+def split(faces, names):
+    """
+    split the faces into alternate halves, the model is calibrated on the first
+    and checked on the held out second so the check is not biased by calibration
+    :return: tuple of (calibration faces, held out faces, names of the held out faces)
+    """
+    return faces[0::2], faces[1::2], names[1::2]
+
+
+def passed(report, similarity=config.QUANTIZATION_SIMILARITY, agreement=config.QUANTIZATION_AGREEMENT):
+    """
+    :return: True if the quantized model is close enough to the float32 model
+    """
+    if report["mean_similarity"] < similarity:
+        return False
+    return report.get("agreement", 1.0) >= agreement
+
+
+def check(reference, candidate, faces, names, subject, threshold):
+    """
+    compare the embeddings and recognition results of a quantized model against the float32 model
+    :param reference: float32 `FaceNet`
+    :param candidate: quantized `FaceNet`
+    :param faces: aligned faces
+    :param names: names of the students the faces belong to
+    :param subject: subject whose classifier recognizes the faces
+    :param threshold: threshold value for recognizing the faces
+    :return: dict of the accuracy metrics
+    """
+    expected, actual = reference.encoder(faces=faces), candidate.encoder(faces=faces)
+    similarity = np.sum(expected * actual, axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+
+    report = {
+        "faces": len(faces),
+        "mean_similarity": float(np.mean(similarity)),
+        "min_similarity": float(np.min(similarity)),
+    }
+
+    classifier, roster = Registry()[subject]
+    if classifier is not None:
+        expected, _ = Predict.classify(classifier, roster, expected, threshold)
+        actual, _ = Predict.classify(classifier, roster, actual, threshold)
+        names = np.asarray(names, dtype=object)
+        report["agreement"] = float(np.mean(np.asarray(expected, dtype=object) == np.asarray(actual, dtype=object)))
+        report["float32_accuracy"] = float(np.mean(np.asarray(expected, dtype=object) == names))
+        report["quantized_accuracy"] = float(np.mean(np.asarray(actual, dtype=object) == names))
+
+    return report
+
+
+def main(arguments):
+    # twice the samples are aligned, every other face is held out for the check
+    faces, names = calibration_faces(path=arguments.input, samples=arguments.samples * 2)
+    calibration, faces, names = split(faces, names)
+    logger.info('{} faces found for calibration, {} held out for the check'.format(len(calibration), len(faces)))
+    if not faces:
+        logger.error('not enough faces to hold out for the accuracy check')
+        sys.exit(1)
+
+    path = FaceNet.artifact(quantization=arguments.quantization)
+    FaceNet.export(path=path, quantization=arguments.quantization, calibration=calibration)
+
+    report = check(reference=FaceNet(frozen=False), candidate=FaceNet(frozen=path), faces=faces, names=names,
+                   subject=arguments.subject, threshold=arguments.threshold)
+    logger.info('accuracy check of the {} model: {}'.format(arguments.quantization, report))
+
+    if not passed(report, similarity=arguments.similarity, agreement=arguments.agreement):
+        logger.error('the {} model does not match the float32 model closely enough'.format(arguments.quantization))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a quantized FaceNet and check its accuracy')
+    parser.add_argument('-q', '--quantization', help='quantization of the exported model',
+                        type=str, choices=['float16', 'int8'], default='int8')
+    parser.add_argument('-i', '--input', help='path to the training data used for calibration',
+                        metavar='', type=str, default=config.TRAINING_DATA)
+    parser.add_argument('-n', '--samples', help='number of faces used for calibration, as many are held out for the check',
+                        metavar='', type=int, default=config.CALIBRATION_SAMPLES)
+    parser.add_argument('-c', '--subject', help='subject whose classifier is used for the accuracy check',
+                        metavar='', type=str, default='General')
+    parser.add_argument('-p', '--threshold', help='threshold value for recognizing the faces',
+                        metavar='', type=int, default=27)
+    parser.add_argument('-s', '--similarity', help='minimum mean cosine similarity to the float32 embeddings',
+                        metavar='', type=float, default=config.QUANTIZATION_SIMILARITY)
+    parser.add_argument('-a', '--agreement', help='minimum fraction of faces recognized the same as float32',
+                        metavar='', type=float, default=config.QUANTIZATION_AGREEMENT)
+
+    args = parser.parse_args()
+    main(args)
@@ -5,15 +5,12 @@ sys.path.append(os.path.abspath('..'))
 from consolemenu import *
 from consolemenu.format import *
 from consolemenu.items import *
-from model.train import train
-from model.preprocess import Preprocessor
 from model.utilities.config import config
-from model.videoCapture import Stream
-from model.attendance import Attendance
-from model.utilities.filechooser import init_file_selector
-from model.utilities.utils import load_attendance
+from model.utilities.utils import load_attendance, subject_exists
 from shutil import copy
 
+# the commands import tensorflow, keras, dlib and sklearn only when they are selected
+
 
 def input_path(default):
     Screen.println(f"    {default}")
@@ -32,11 +29,16 @@ def input_path(default):
 
 
 def test_camera_callback():
+    from model.videoCapture import Stream
+
     camera = Stream(path=0, display=True)
     camera.capture()
 
 
 def add_student_callback():
+    from model.train import enroll
+    from model.utilities.filechooser import init_file_selector
+
     print()
     name = input("    Enter Name: ").title()
     label = input("    Enter Roll No: ")
@@ -48,6 +50,9 @@ def add_student_callback():
         _, extension = os.path.splitext(source)
         copy(source, os.path.join(std_dir, f"{count}{extension}"))
 
+    # update the recognizer with the new student instead of retraining from scratch
+    enroll(path=std_dir)
+
     Screen.clear()
     print()
     Screen.println(f"    Student named: {name} with label: {label} successfully created.")
@@ -56,15 +61,22 @@ def add_student_callback():
 
 
 def train_classifier_callback():
+    from model.train import train
+    from model.preprocess import Preprocessor
+
     path = input_path(config.TRAINING_DATA)
     if path:
+        # only the support vector classifier has parameters to search
+        search = config.RECOGNIZER == "svc" and input(
+            "    Grid search the classifier parameters? (y/N) - ").lower() == "y"
+
         # initiate data processor
         preprocessor = Preprocessor(path=path)
         preprocessor.preprocess()
 
         for subject in preprocessor.data:
             data = Preprocessor.to_dataframe(subject)
-            train(data=data, subject=subject.name)
+            train(data=data, subject=subject.name, search=search)
 
         Screen.clear()
         Screen.println("")
@@ -73,6 +85,8 @@ def train_classifier_callback():
 
 
 def take_attendance_callback():
+    from model.attendance import Attendance
+
     Screen.println("    Attendance will be taken using the data found at path:.....")
     path = input_path(os.path.join(config.BASE_DIR, "test-data"))
 
@@ -98,7 +112,7 @@ def take_attendance_callback():
 def show_attendance_callback():
     subject = input("    Enter Subject Name:.......")
     subject = "General" if subject == "" else subject
-    subject = Attendance.exist(subject)
+    subject = subject_exists(subject)
 
     if subject:
         attendance, _ = load_attendance(subject=subject)
@@ -1,16 +1,17 @@
 import os
-import pickle
 import argparse
+import numpy as np
 import pandas as pd
 from loguru import logger
 
 from model.utilities.classifier import Classifier
+from model.utilities.data import Data, Entity
 from preprocess import Preprocessor
-from utilities.utils import log_and_exit, save_attendance
+from utilities.utils import log_and_exit, save_attendance, load_attendance
 from model.utilities.config import config
 
 
-def train(data, subject=None):
+def train(data, subject=None, search=False):
     # saving the csv file for marking attendance
     labels = pd.unique(data.Labels)
     labels = pd.DataFrame(labels, columns=['Labels'])
@@ -21,10 +22,52 @@ def train(data, subject=None):
 
     # Training the classifier
     classifier = Classifier(data)
-    print(config.CLASSIFIER_FILE_SUFFIX)
-    # SVC classification
-    svc = classifier.train_svc()
-    pickle.dump(svc, open(os.path.join(config.TRAINED_DATA, '{}{}.sav'.format(subject, config.CLASSIFIER_FILE_SUFFIX)), 'wb'))
+    model = classifier.train(search=search)
+    Classifier.save(model, subject)
+
+
+def enroll(path, subject=None, preprocessor=None):
+    """
+    add the student found at path to the subject's recognizer without retraining from scratch,
+    recognizers that can not be updated in place are refitted on the cached embeddings
+    :param path: path to the student folder
+    :param subject: name of the subject, defaults to the subject of the parent folder
+    :param preprocessor: `Preprocessor` object to reuse its detector, model and cache
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    subject = subject if subject else Data.verbose_name(root)[0]
+    preprocessor = preprocessor if preprocessor else Preprocessor(path=root)
+
+    classifier = Classifier.load(config.TRAINED_DATA, subject)
+    attendance, names = load_attendance(subject=subject)
+
+    if classifier is None or attendance is None or not hasattr(classifier, "partial_fit"):
+        logger.info('retraining the recognizer of subject {}'.format(subject))
+        for data in preprocessor.preprocess(path=root):
+            train(data=Preprocessor.to_dataframe(data), subject=data.name)
+        return
+
+    entity = Entity(path)
+    entity.preprocess(model=preprocessor.model, detector=preprocessor.detector, cache=preprocessor.cache)
+    if preprocessor.cache is not None:
+        preprocessor.cache.save()
+
+    if len(entity.encodings) == 0:
+        logger.warning('no face found in the images of student {}, not enrolled'.format(entity))
+        return
+
+    if entity.name not in attendance.index:
+        # the roster saved by `train` has no columns until attendance is marked, so the row is
+        # appended by reindexing, setting it with `.loc` fails on a frame without columns
+        index = attendance.index.append(pd.Index([entity.name], name=attendance.index.name))
+        attendance = attendance.reindex(index, fill_value='-')
+    label = attendance.index.get_loc(entity.name)
+
+    logger.info('enrolling student {} in subject {}'.format(entity, subject))
+    classifier.partial_fit(entity.encodings, np.full(len(entity.encodings), label))
+
+    save_attendance(subject=subject, data=attendance)
+    Classifier.save(classifier, subject)
 
 
 def main(arguments):
@@ -41,7 +84,7 @@ def main(arguments):
 
     for subject in preprocessor.data:
         data = Preprocessor.to_dataframe(subject)
-        train(data=data, subject=subject.name)
+        train(data=data, subject=subject.name, search=arguments.search)
 
 
 if __name__ == '__main__':
@@ -50,6 +93,8 @@ if __name__ == '__main__':
                         metavar='', type=str, default=os.path.join(config.TRAINING_DATA))
     parser.add_argument('-o', '--output', help='path to the folder where trained results are to be saved',
                         metavar='', type=str, default=os.path.join(config.TRAINED_DATA))
+    parser.add_argument('-s', '--search', help='grid search the parameters of the support vector classifier',
+                        action='store_true')
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,108 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+from loguru import logger
+
+from model.utilities.config import config
+
+
+class EmbeddingCache:
+    """
+    Persistent store of the face embeddings of the training images.
+    Embeddings are keyed by the sha1 hash of the image content together with
+    the detector/model version and the quantization of the model, so an image is
+    only detected, aligned and encoded again when its content or the encoder changes.
+    """
+
+    def __init__(self, path=None, version=None):
+        self.path = path if path else os.path.join(config.TRAINED_DATA, config.EMBEDDING_CACHE)
+        self.version = version if version else self.encoder_version()
+        self.embeddings = {}
+        # keys of the images looked up or encoded in this run
+        self.seen = set()
+        self.modified = False
+
+    @staticmethod
+    def encoder_version(quantization=config.QUANTIZATION):
+        """
+        :return: version of the encoder, quantized models produce different embeddings
+        """
+        return '{}:{}'.format(config.ENCODER_VERSION, quantization if quantization else 'float32')
+
+    @classmethod
+    def load(cls, path=None, version=None):
+        cache = cls(path=path, version=version)
+        if os.path.isfile(cache.path):
+            try:
+                with open(cache.path, 'rb') as file:
+                    cache.embeddings = pickle.load(file)
+            except Exception as e:
+                logger.warning('ignoring unreadable embedding cache {}: {}'.format(cache.path, e))
+
+        logger.info('{} cached embeddings loaded'.format(len(cache)))
+        return cache
+
+    def save(self, prune=False):
+        """
+        :param prune: drop the embeddings of the images not seen in this run, i.e. changed or
+                      deleted images and older encoder versions, only if the run covered all the training data
+        """
+        if prune:
+            stale = set(self.embeddings) - self.seen
+            for key in stale:
+                del self.embeddings[key]
+            if stale:
+                logger.info('{} stale embeddings pruned from the cache'.format(len(stale)))
+                self.modified = True
+
+        if not self.modified:
+            return
+
+        # write to a temporary file first so an interrupted save never corrupts the cache
+        temporary = '{}.tmp'.format(self.path)
+        with open(temporary, 'wb') as file:
+            pickle.dump(self.embeddings, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path)
+        self.modified = False
+
+    def key(self, image):
+        """
+        :param image: `Image` object of a training image
+        :return: content hash of the image combined with the encoder version
+        """
+        digest = hashlib.sha1()
+        with open(image.path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 16), b''):
+                digest.update(block)
+        return '{}:{}'.format(self.version, digest.hexdigest())
+
+    def lookup(self, images):
+        """
+        split the images into the ones already encoded and the ones still to be processed
+        :param images: list of `Image` objects
+        :return: tuple of (list of cached embeddings, list of images not found in the cache)
+        """
+        hits, misses = [], []
+        for image in images:
+            image.key = self.key(image)
+            self.seen.add(image.key)
+            embedding = self.embeddings.get(image.key)
+            if embedding is None:
+                misses.append(image)
+            else:
+                hits.append(embedding)
+        return hits, misses
+
+    def update(self, images, embeddings):
+        for image, embedding in zip(images, embeddings):
+            key = getattr(image, "key", None) or self.key(image)
+            self.seen.add(key)
+            self.embeddings[key] = np.asarray(embedding, dtype=np.float32)
+        self.modified = True
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def __contains__(self, image):
+        return self.key(image) in self.embeddings
@@ -1,12 +1,11 @@
 import os
+import time
 import pickle
+import numpy as np
 from loguru import logger
 
-from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import GridSearchCV
-from sklearn.svm import SVC
-from sklearn.neighbors import KNeighborsClassifier
 from model.utilities.config import config
+from model.utilities.utils import load_attendance
 
 
 class Classifier:
@@ -18,13 +17,31 @@ class Classifier:
 
     @staticmethod
     def preprocess(data):
+        from sklearn.preprocessing import LabelEncoder
+
         # encoding categories to numbers
         encoder = LabelEncoder()
         data.iloc[:, -1] = encoder.fit_transform(data.iloc[:, -1])
         classes = len(encoder.classes_)
         return data, classes
 
-    def train_svc(self):
+    def train(self, recognizer=config.RECOGNIZER, search=False):
+        if recognizer == "centroid":
+            return self.train_centroids()
+        if recognizer == "svc":
+            return self.train_svc(search=search)
+        if recognizer == "index":
+            return self.train_index()
+        raise ValueError("unknown recognizer: {}".format(recognizer))
+
+    def train_svc(self, search=True):
+        from sklearn.svm import SVC
+
+        if not search:
+            model = SVC(**config.SVC_PARAMS)
+            model.fit(self.x, self.y)
+            return model
+
         # defining parameter range
         param_grid = {'kernel': ('linear', 'rbf'),
                       'C': [1, 10],
@@ -34,7 +51,19 @@ class Classifier:
         logger.info('optimal parameters for support vector classifier: {}'.format(model.best_estimator_))
         return model
 
+    def train_centroids(self):
+        model = Centroids()
+        model.fit(self.x, self.y)
+        return model
+
+    def train_index(self):
+        model = EmbeddingIndex()
+        model.fit(self.x, self.y)
+        return model
+
     def train_knn(self):
+        from sklearn.neighbors import KNeighborsClassifier
+
         # defining parameter range
         param_grid = {'n_neighbors': range(5, 20),
                       'algorithm': ['auto', 'ball_tree', 'kd_tree', 'brute'],
@@ -49,6 +78,8 @@ class Classifier:
 
     @staticmethod
     def fine_tune_model(model, param):
+        from sklearn.model_selection import GridSearchCV
+
         grid = GridSearchCV(model, param_grid=param, refit=True, verbose=3, cv=2)
         return grid
 
@@ -61,4 +92,246 @@ class Classifier:
 
         return None
 
+    @staticmethod
+    def save(model, subject, path=config.TRAINED_DATA):
+        with open(Classifier.path(subject, path), 'wb') as file:
+            pickle.dump(model, file)
+
+    @staticmethod
+    def path(subject, path=config.TRAINED_DATA):
+        return os.path.join(path, '{}{}.sav'.format(subject, config.CLASSIFIER_FILE_SUFFIX))
+
+
+def confidence(similarity, midpoint, temperature=config.SIMILARITY_TEMPERATURE):
+    """
+    map cosine similarities to a confidence in [0, 1] with a logistic centred at `midpoint`,
+    the centroid and index recognizers share it so the recognition threshold means the same for both
+    :param similarity: cosine similarities
+    :param midpoint: similarity scored as 0.5
+    :param temperature: steepness of the logistic
+    :return: numpy.ndarray of the confidences
+    """
+    return 1 / (1 + np.exp(-temperature * (np.asarray(similarity) - midpoint)))
+
+
+class Centroids:
+    """
+    Nearest centroid recognizer over L2 normalized face embeddings.
+    Every class is represented by the running sum of its embeddings, so new
+    students can be enrolled with `partial_fit` without retraining the others.
+    Follows the sklearn `classes_`, `predict` and `predict_proba` interface, the
+    confidence of each class depends only on the similarity to its own centroid
+    so it does not drop as the roster grows.
+    """
+
+    def __init__(self, temperature=config.SIMILARITY_TEMPERATURE, midpoint=config.CENTROID_SIMILARITY):
+        self.temperature = temperature
+        self.midpoint = midpoint
+        self.classes_ = np.zeros(0, dtype=int)
+        self.sums = np.zeros((0, 128), dtype=np.float32)
+        self.counts = np.zeros(0, dtype=int)
+        self.centroids = np.zeros((0, 128), dtype=np.float32)
+
+    def fit(self, x, y):
+        self.__init__(temperature=self.temperature, midpoint=self.midpoint)
+        return self.partial_fit(x, y)
+
+    def partial_fit(self, x, y):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 128)
+        y = np.asarray(y)
+
+        for label in np.unique(y):
+            mask = y == label
+            index = np.flatnonzero(self.classes_ == label)
+            if index.size:
+                self.sums[index[0]] += x[mask].sum(axis=0)
+                self.counts[index[0]] += mask.sum()
+            else:
+                self.classes_ = np.append(self.classes_, label)
+                self.sums = np.vstack([self.sums, x[mask].sum(axis=0)])
+                self.counts = np.append(self.counts, mask.sum())
+
+        norms = np.linalg.norm(self.sums, axis=1, keepdims=True)
+        self.centroids = self.sums / np.maximum(norms, 1e-12)
+        return self
+
+    def similarity(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 128)
+        x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        return x @ self.centroids.T
+
+    def predict_proba(self, x):
+        """
+        :return: confidence of every class, a logistic of the cosine similarity to its centroid,
+                 the rows do not sum to one unlike a softmax over the whole roster
+        """
+        return confidence(self.similarity(x), self.midpoint, self.temperature)
+
+    def predict(self, x):
+        return self.classes_[np.argmax(self.similarity(x), axis=1)]
+
+
+class EmbeddingIndex:
+    """
+    Nearest neighbour index over the enrolled face embeddings.
+    Embeddings are stored in one contiguous float32 matrix and searched exactly
+    by brute force, or, when `lists` > 0, partitioned IVF-style into k-means
+    lists of which only the `probes` nearest ones are scanned per face.
+    `identify` returns the label of the nearest embedding with the same logistic
+    confidence as `Centroids`, 50% at the similarity `midpoint`, so the recognition
+    threshold rejects unknown faces the same way for both recognizers.
+    """
+
+    def __init__(self, metric=config.INDEX_METRIC, lists=config.INDEX_LISTS, probes=config.INDEX_PROBES,
+                 midpoint=config.INDEX_SIMILARITY, temperature=config.SIMILARITY_TEMPERATURE):
+        assert metric in ("cosine", "l2"), "metric should be either cosine or l2"
+        self.metric = metric
+        self.midpoint = midpoint
+        self.temperature = temperature
+        self.lists = lists
+        self.probes = probes
+        self.classes_ = np.zeros(0, dtype=int)
+        self.embeddings = np.zeros((0, 128), dtype=np.float32)
+        self.labels = np.zeros(0, dtype=int)
+        self.quantizer = None
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def normalize(x):
+        x = np.ascontiguousarray(np.asarray(x, dtype=np.float32).reshape(-1, 128))
+        return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+    def fit(self, x, y):
+        self.embeddings = np.zeros((0, 128), dtype=np.float32)
+        self.labels = np.zeros(0, dtype=int)
+        self.quantizer = None
+        return self.partial_fit(x, y)
+
+    def partial_fit(self, x, y):
+        self.embeddings = np.concatenate([self.embeddings, self.normalize(x)])
+        self.labels = np.concatenate([self.labels, np.asarray(y, dtype=int)])
+        self.classes_ = np.unique(self.labels)
+        self.partition()
+        return self
+
+    def partition(self):
+        """
+        group the embeddings by their nearest k-means list so every list is a contiguous slice,
+        the lists are only trained once and new embeddings are assigned to the existing ones
+        """
+        if self.lists <= 0 or len(self) < self.lists:
+            self.quantizer, self.offsets = None, None
+            return
+
+        if self.quantizer is None:
+            from sklearn.cluster import KMeans
+
+            kmeans = KMeans(n_clusters=self.lists, n_init=1).fit(self.embeddings)
+            self.quantizer = self.normalize(kmeans.cluster_centers_)
+
+        assignment = np.argmax(self.embeddings @ self.quantizer.T, axis=1)
+        order = np.argsort(assignment, kind='stable')
+        self.embeddings = np.ascontiguousarray(self.embeddings[order])
+        self.labels = self.labels[order]
+        self.offsets = np.searchsorted(assignment[order], np.arange(self.lists + 1))
+
+    def search(self, x):
+        """
+        :param x: face embeddings. Shape: (n, 128)
+        :return: tuple of (indices of the nearest embeddings, cosine similarities)
+        """
+        x = self.normalize(x)
+        if self.quantizer is None:
+            similarities = x @ self.embeddings.T
+            indices = np.argmax(similarities, axis=1)
+            return indices, similarities[np.arange(len(x)), indices]
+
+        indices = np.zeros(len(x), dtype=int)
+        best = np.full(len(x), -1., dtype=np.float32)
+        probes = np.argsort(-(x @ self.quantizer.T), axis=1)[:, :self.probes]
+        for row, lists in enumerate(probes):
+            candidates = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+            if candidates.size == 0:
+                continue
+            similarities = self.embeddings[candidates] @ x[row]
+            nearest = np.argmax(similarities)
+            indices[row], best[row] = candidates[nearest], similarities[nearest]
+
+        return indices, best
+
+    def identify(self, x):
+        """
+        :param x: face embeddings. Shape: (n, 128)
+        :return: tuple of (labels, confidence in percent)
+        """
+        indices, similarities = self.search(x)
+        if self.metric == "l2":
+            # the logistic is centred at the distance between unit vectors of the midpoint similarity
+            distances = np.sqrt(np.maximum(2. - 2. * similarities, 0.))
+            scores = confidence(-distances, -np.sqrt(2. - 2. * self.midpoint), self.temperature)
+        else:
+            scores = confidence(similarities, self.midpoint, self.temperature)
+        return self.labels[indices], scores * 100
+
+    def predict(self, x):
+        return self.identify(x)[0]
+
+
+class Registry:
+    """
+    In-memory cache of the trained classifier and the enrolled labels of each subject.
+    The cached entry of a subject is reloaded only when the modification time
+    of its classifier or attendance file changes; the files are checked at most
+    once every `refresh` seconds so that the hot loop does no disk I/O.
+    """
+
+    def __init__(self, path=config.TRAINED_DATA, refresh=config.REGISTRY_REFRESH):
+        self.path = path
+        self.refresh = refresh
+        self.__entries = {}
+
+    def __getitem__(self, subject):
+        return self.get(subject)
+
+    def __contains__(self, subject):
+        return subject in self.__entries
+
+    def files(self, subject):
+        attendance = '{}{}.csv'.format(subject, config.ATTENDANCE_FILE_SUFFIX)
+        return Classifier.path(subject, self.path), os.path.join(self.path, attendance)
+
+    def signature(self, subject):
+        return tuple(os.path.getmtime(file) if os.path.isfile(file) else None for file in self.files(subject))
+
+    def get(self, subject):
+        """
+        :param subject: name of the subject
+        :return: tuple of (classifier, names)
+        """
+        entry = self.__entries.get(subject)
+        now = time.monotonic()
+
+        if entry is not None and now - entry["checked"] < self.refresh:
+            return entry["classifier"], entry["names"]
+
+        signature = self.signature(subject)
+        if entry is None or entry["signature"] != signature:
+            logger.info('loading classifier and attendance for subject {}'.format(subject))
+            entry = {
+                "classifier": Classifier.load(self.path, subject),
+                "names": load_attendance(subject=subject)[1],
+                "signature": signature,
+            }
+            self.__entries[subject] = entry
+
+        entry["checked"] = now
+        return entry["classifier"], entry["names"]
 
+    def invalidate(self, subject=None):
+        if subject is None:
+            self.__entries.clear()
+        else:
+            self.__entries.pop(subject, None)
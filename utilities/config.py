@@ -7,15 +7,115 @@ class Config:
     # Path to the pre-trained model weights
     MODEL = join(BASE_DIR, 'models/open_face.h5')
 
+    # Path to the frozen inference graph exported by `python faceNet.py`, used instead of MODEL if it exists
+    FROZEN_MODEL = join(BASE_DIR, 'models/open_face_frozen')
+
+    # quantized FaceNet variant to use: None for float32, "float16" or "int8"
+    QUANTIZATION = None
+
+    # Path to the quantized models exported by `python quantize.py`, formatted with the quantization
+    QUANTIZED_MODEL = join(BASE_DIR, 'models/open_face_{}.tflite')
+
+    # number of aligned training faces the int8 model is calibrated and checked on
+    CALIBRATION_SAMPLES = 200
+
+    # minimum mean cosine similarity of the quantized to the float32 embeddings on the held out faces
+    QUANTIZATION_SIMILARITY = 0.98
+
+    # minimum fraction of the held out faces the quantized and float32 models recognize the same
+    QUANTIZATION_AGREEMENT = 0.98
+
+    # number of timed runs of every stage of the benchmark
+    BENCHMARK_REPEAT = 20
+
+    # relative slowdown of a benchmarked stage reported as a regression
+    BENCHMARK_TOLERANCE = 0.1
+
     # Path to the pre-trained model weights
     DETECTOR = join(BASE_DIR, 'models/landmarks.dat')
 
+    # threads of the OpenMP, BLAS and OpenCV runtimes of every process, 0 keeps their defaults
+    NUM_THREADS = 0
+
+    # threads tensorflow uses within a single op, 0 lets tensorflow decide
+    INTRA_OP_THREADS = 0
+
+    # number of tensorflow ops run in parallel, 0 lets tensorflow decide
+    INTER_OP_THREADS = 0
+
+    # cores every process is pinned to e.g. [0, 1], None runs on all cores
+    CPU_AFFINITY = None
+
+    # factor the frames are downscaled by before detecting faces, landmarks use the full resolution
+    DETECTION_SCALE = 1.0
+
+    # number of times the detector upsamples the frame to find smaller faces
+    DETECTION_UPSAMPLE = 1
+
+    # search only around the faces of the previous frame of a video instead of the whole frame
+    ROI_DETECTION = False
+
+    # fraction of the face size the search window is expanded by on every side
+    ROI_MARGIN = 0.5
+
+    # number of analysed frames after which the whole frame is scanned again for new faces
+    ROI_REFRESH = 10
+
+    # reuse the labels of faces confirmed present instead of encoding them on every frame
+    IDENTITY_CACHE = False
+
+    # minimum trust score for the label of a confirmed face to be reused
+    IDENTITY_TRUST = 60
+
+    # number of analysed frames after which a reused label is verified again
+    IDENTITY_REVERIFY = 30
+
+    # minimum overlap between the boxes of a face in two frames for it to count as the same face
+    IDENTITY_OVERLAP = 0.5
+
+    # number of faces encoded by FaceNet in a single forward pass
+    BATCH_SIZE = 32
+
     # path to the output folder
     OUTPUT = join(BASE_DIR, 'output')
 
     # path to folder where the resultant files are to be saved after training
     TRAINED_DATA = join(OUTPUT, "trained-data")
 
+    # reuse the embeddings of unchanged training images instead of encoding them again
+    CACHE_EMBEDDINGS = True
+
+    # file inside TRAINED_DATA where the embeddings of the training images are cached
+    EMBEDDING_CACHE = "embeddings.pkl"
+
+    # version of the detector/encoder pair, change it to invalidate the cached embeddings
+    ENCODER_VERSION = "dlib-68-landmarks:openface-nn4.small2.v1"
+
+    # recognizer trained on the embeddings: the incrementally updatable "centroid" or "index",
+    # or "svc" which is refitted on all the cached embeddings whenever a student is added
+    RECOGNIZER = "centroid"
+
+    # parameters of the support vector classifier when grid search is not requested
+    SVC_PARAMS = {'kernel': 'rbf', 'C': 10, 'probability': True}
+
+    # steepness of the logistic mapping the similarities of the centroid and index recognizers to a confidence
+    SIMILARITY_TEMPERATURE = 10.0
+
+    # cosine similarity to the best centroid scored as 50% confidence, about 0.5 lies at the threshold of 27
+    CENTROID_SIMILARITY = 0.6
+
+    # similarity used by the nearest neighbour index: "cosine" or "l2"
+    INDEX_METRIC = "cosine"
+
+    # cosine similarity to the nearest enrolled embedding scored as 50% confidence
+    INDEX_SIMILARITY = 0.6
+
+    # number of k-means lists of the nearest neighbour index, 0 searches all embeddings exactly
+    INDEX_LISTS = 0
+
+    # number of nearest lists scanned per face when the index is partitioned
+    INDEX_PROBES = 4
+
     # path to folder from the data is to be taken for training
     TRAINING_DATA = join(BASE_DIR, "training-data")
 
@@ -25,9 +125,57 @@ class Config:
     # remove files after training
     REMOVE = False
 
+    # seconds between checks for a retrained classifier or attendance file on disk
+    REGISTRY_REFRESH = 5.0
+
     # number of consecutive frames in which the entity should appear to be mark present
     MAX_FRAME = 5
 
+    # number of thumbnails of the latest frames kept for every entity of a video, 0 keeps none
+    TRACKER_KEYFRAMES = 0
+
+    # width in pixels of the kept thumbnails
+    TRACKER_THUMBNAIL = 160
+
+    # run the full recognition pipeline on every n-th frame of a video, faces are tracked in between
+    DETECTION_INTERVAL = 1
+
+    # frames per second of the video to run the full recognition on, overrides the interval when set
+    ANALYSIS_RATE = None
+
+    # decode the frames of a video on a background thread
+    THREADED_CAPTURE = True
+
+    # number of decoded frames buffered ahead of recognition
+    CAPTURE_BUFFER = 4
+
+    # process videos without drawing annotations or opening windows, e.g. on a server
+    HEADLESS = False
+
+    # JPEG quality of the written annotated images, from 0 to 100
+    OUTPUT_QUALITY = 90
+
+    # maximum number of annotated images waiting to be written
+    WRITER_QUEUE = 32
+
+    # record the stage timers, counters and queue depths in the in-process metrics registry
+    METRICS = False
+
+    # prefix of the metric names in the Prometheus export
+    METRICS_PREFIX = "face_attendance"
+
+    # process recorded videos with a multi-process pipeline of detection, encoding and classification
+    PIPELINE = False
+
+    # number of worker processes of each pipeline stage
+    PIPELINE_WORKERS = {"detect": 2, "encode": 1, "classify": 1}
+
+    # maximum number of items waiting between two pipeline stages
+    PIPELINE_QUEUE = 8
+
+    # number of processes recording the files of a folder in parallel, 1 records them one after another
+    RECORD_WORKERS = 1
+
     # Name Separator
     SEPARATOR = "__"
 
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 from loguru import logger
 
 from model.utilities.utils import get_folders, get_files, log_and_exit
@@ -35,14 +36,45 @@ class Entity:
     def dir_name(self):
         return self.isValid(self.path)
 
-    def faces(self, detector):
-        for image in self.__iter__():
+    def faces(self, detector, images=None):
+        for image, face in self.aligned(detector=detector, images=images):
+            yield face
+
+    def aligned(self, detector, images=None):
+        """
+        detect and align the face in each image of the entity,
+        images in which no face is found are deleted
+        :param detector: `FaceDetector` object
+        :param images: subset of the entity's images, defaults to all of them
+        :return: generator of (image, face) tuples
+        """
+        for image in (images if images is not None else self.__iter__()):
             face = detector.align_face(image_dimensions=96, image=image(),
                                        landmark_indices=detector.OUTER_EYES_AND_NOSE)
             if face is None:
                 os.unlink(image.path)
                 continue
-            yield face
+            yield image, face
+
+    def preprocess(self, model, detector, cache=None):
+        logger.info('preprocessing data for student label {}'.format(self))
+        encodings, images = [], self.images
+
+        # only the new or changed images are to be processed if the embeddings are cached
+        if cache is not None:
+            encodings, images = cache.lookup(self.images)
+            logger.info('{} of {} images found in cache'.format(len(encodings), len(self.images)))
+
+        if images:
+            # encode the faces chunk by chunk while the next chunk is being detected and aligned
+            pairs = self.aligned(detector=detector, images=images)
+            for processed, embeddings in model.stream_encoder(pairs, chunk_size=config.BATCH_SIZE, pairs=True):
+                if cache is not None:
+                    cache.update(processed, embeddings)
+                encodings.extend(embeddings)
+
+        self.encodings = np.array(encodings, dtype=np.float32).reshape(-1, 128)
+        return self.encodings
 
     def __str__(self):
         return self.name.title()
@@ -116,10 +148,9 @@ class Data:
             return directory
         return False
 
-    def preprocess(self, model, detector):
+    def preprocess(self, model, detector, cache=None):
         for index, entity in enumerate(self.__iter__()):
-            logger.info('preprocessing data for student label {}'.format(entity))
-            entity.encodings = model.encoder(faces=entity.faces(detector=detector))
+            entity.preprocess(model=model, detector=detector, cache=cache)
 
     def dir_name(self):
         return os.path.basename(self.path)
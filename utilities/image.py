@@ -1,5 +1,8 @@
 import cv2
-from os.path import basename, isfile, join
+import threading
+from abc import ABC, abstractmethod
+from queue import Queue
+from os.path import basename, isfile, join, splitext
 
 from loguru import logger
 from filetype import guess
@@ -7,6 +10,9 @@ from filetype import guess
 from skimage import exposure
 from skimage.feature import hog
 
+from model.utilities.config import config
+from model.utilities.metrics import metrics
+
 
 class Image:
     """
@@ -48,8 +54,11 @@ class Image:
 
 
 # OpenCv Utilities
-def normalize_histogram(image, grid=16):
+def normalize_histogram(image, grid=16, scale=1.0):
     image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if scale != 1.0:
+        # downscale the grayscale image, cheaper than resizing all three channels
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     normalizer = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(grid, grid))
     normalized_image = normalizer.apply(image)
     return normalized_image
@@ -91,6 +100,111 @@ def save_image(image, name, path, converter=None):
     cv2.imwrite(path, image)
 
 
+class AsyncWriter(ABC):
+    """
+    Sink encoding and writing the annotated images on a background thread
+    so that disk and encode time stay off the recognition loop. At most
+    `size` images wait in the queue, `write` blocks once it is full.
+    The first failed write is raised by `close`.
+    """
+
+    def __init__(self, size=config.WRITER_QUEUE):
+        self.queue = Queue(maxsize=size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for image, name in iter(self.queue.get, None):
+            try:
+                self.encode(image, name)
+            except Exception as e:
+                logger.error('failed writing {}: {}'.format(name, e))
+                self.error = self.error or e
+
+        try:
+            self.release()
+        except Exception as e:
+            logger.error('failed releasing the writer: {}'.format(e))
+            self.error = self.error or e
+
+    @abstractmethod
+    def encode(self, image, name):
+        pass
+
+    def release(self):
+        pass
+
+    def write(self, image, name=None):
+        metrics.gauge("writer_queue", self.queue.qsize())
+        self.queue.put((image, name))
+
+    def close(self):
+        # wait for the queued images to be written
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncImageWriter(AsyncWriter):
+    """
+    Writes every image to a file in a folder, with the given JPEG quality or PNG compression
+    """
+
+    def __init__(self, path, quality=config.OUTPUT_QUALITY, size=config.WRITER_QUEUE):
+        self.path = path
+        self.quality = quality
+        super(AsyncImageWriter, self).__init__(size=size)
+
+    def params(self, name):
+        extension = splitext(name)[1].lower()
+        if extension in ('.jpg', '.jpeg'):
+            return [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)]
+        if extension == '.png':
+            # map quality 0-100 to compression 9-0
+            return [cv2.IMWRITE_PNG_COMPRESSION, int(round(9 - self.quality * 9 / 100))]
+        return []
+
+    def encode(self, image, name):
+        cv2.imwrite(join(self.path, name), image, self.params(name))
+
+
+class AsyncVideoWriter(AsyncWriter):
+    """
+    Writes the images as the frames of a video through `cv2.VideoWriter`,
+    the video is opened with the size of the first frame. Without a given `fps`
+    the video takes the frame rate of the `Stream` writing to it.
+    """
+
+    # frame rate used if neither the writer nor the source stream provide one
+    FPS = 25
+
+    def __init__(self, path, fps=None, codec='mp4v', size=config.WRITER_QUEUE):
+        self.path = path
+        self.fps = fps
+        self.codec = codec
+        self.writer = None
+        super(AsyncVideoWriter, self).__init__(size=size)
+
+    def encode(self, image, name):
+        if self.writer is None:
+            height, width = image.shape[:2]
+            fps = self.fps if self.fps else self.FPS
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.codec), fps, (width, height))
+        self.writer.write(image)
+
+    def release(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
 # Utilities Used by Detector.py
 def rect_to_bounding_box(rect):
     """
@@ -107,6 +221,21 @@ def rect_to_bounding_box(rect):
     return x, y, w, h
 
 
+def overlap(first, second):
+    """
+    intersection over union of two dlib's rect objects
+    :param first:
+    :param second:
+    :return float: value between 0 and 1
+    """
+    width = min(first.right(), second.right()) - max(first.left(), second.left())
+    height = min(first.bottom(), second.bottom()) - max(first.top(), second.top())
+    if width <= 0 or height <= 0:
+        return 0.
+    intersection = width * height
+    return intersection / float(first.area() + second.area() - intersection)
+
+
 def draw_text(image, text, face_location, color=(0, 0, 255), rect=True):
     """
     function to draw text on give image starting from
@@ -137,7 +266,6 @@ def draw_rectangles(image, face_locations, color=(0, 0, 255), thickness=5, rect=
     :param thickness: integer value
     :return image: a new image with rectangles drawn on it
     """
-    logger.info('Drawing rectangles around detected faces')
     if rect:
         face_locations = list(map(lambda location: rect_to_bounding_box(location), face_locations))
 
@@ -0,0 +1,174 @@
+import json
+import time
+import threading
+from bisect import bisect_left
+
+from model.utilities.config import config
+
+
+class Timer:
+    """
+    Context manager recording the duration of its block in a `Metrics` registry
+    """
+
+    __slots__ = ("registry", "name", "start")
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer:
+    """
+    Timer of a disabled registry, records nothing
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """
+    In-process registry of the stage timers, counters and gauges of the recognition pipeline.
+    Timers keep the count, sum, maximum and histogram buckets of the durations in seconds.
+    While disabled every call returns immediately and nothing is recorded. The registry is
+    per process, the worker processes of a `Pipeline` send their snapshots to the parent
+    which merges them into its own.
+    """
+
+    # upper bounds of the histogram buckets of the timers in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, enabled=config.METRICS, prefix=config.METRICS_PREFIX):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def reset(self):
+        with self.lock:
+            self.timers, self.counters, self.gauges = {}, {}, {}
+
+    def timer(self, name):
+        """
+        :param name: name of the stage, e.g. "detect"
+        :return: context manager timing its block
+        """
+        return Timer(self, name) if self.enabled else NULL_TIMER
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                             "buckets": [0] * (len(self.BUCKETS) + 1)}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            timer["buckets"][bisect_left(self.BUCKETS, seconds)] += 1
+
+    def increment(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        :return: dict of the timers, counters and gauges
+        """
+        with self.lock:
+            timers = {name: {"count": timer["count"], "sum": timer["sum"], "max": timer["max"],
+                             "mean": timer["sum"] / timer["count"], "buckets": list(timer["buckets"])}
+                      for name, timer in self.timers.items()}
+            return {"timers": timers, "counters": dict(self.counters), "gauges": dict(self.gauges)}
+
+    def merge(self, snapshot):
+        """
+        add the snapshot of another registry, e.g. of a worker process, to this one
+        :param snapshot: dict returned by `snapshot`
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, other in snapshot["timers"].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    timer = self.timers[name] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                                 "buckets": [0] * (len(self.BUCKETS) + 1)}
+                timer["count"] += other["count"]
+                timer["sum"] += other["sum"]
+                timer["max"] = max(timer["max"], other["max"])
+                timer["buckets"] = [a + b for a, b in zip(timer["buckets"], other["buckets"])]
+
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.gauges.update(snapshot["gauges"])
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, timer in sorted(self.timers.items()):
+                metric = '{}_{}_seconds'.format(self.prefix, name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), timer["buckets"]):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+                lines.append('{}_sum {}'.format(metric, timer["sum"]))
+                lines.append('{}_count {}'.format(metric, timer["count"]))
+
+            for name, value in sorted(self.counters.items()):
+                metric = '{}_{}_total'.format(self.prefix, name)
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+
+            for name, value in sorted(self.gauges.items()):
+                metric = '{}_{}'.format(self.prefix, name)
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        write the metrics to a file, as json if the path ends with .json else in the Prometheus format
+        :param path: path of the file
+        """
+        text = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        with open(path, 'w') as file:
+            file.write(text)
+
+
+metrics = Metrics()
@@ -0,0 +1,83 @@
+import os
+from loguru import logger
+
+from model.utilities.config import config
+
+# environment variables read by the OpenMP and BLAS runtimes of numpy, dlib and tensorflow
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+# runtimes already configured in this process
+configured = set()
+
+
+def cores(affinity=config.CPU_AFFINITY, worker=None, workers=1):
+    """
+    :param affinity: list of the cores the processes may run on, None keeps all cores
+    :param worker: index of a worker process, each worker gets its own slice of the cores
+    :param workers: number of worker processes
+    :return: list of the cores of the process, None to keep all cores
+    """
+    if not affinity:
+        return None
+
+    affinity = sorted(affinity)
+    if worker is None or workers <= 1:
+        return affinity
+    if workers >= len(affinity):
+        # more workers than cores, the workers share the cores round robin
+        return [affinity[worker % len(affinity)]]
+    return affinity[worker * len(affinity) // workers:(worker + 1) * len(affinity) // workers]
+
+
+def configure_threads(threads=config.NUM_THREADS, affinity=config.CPU_AFFINITY, worker=None, workers=1):
+    """
+    limit the OpenMP/BLAS and OpenCV thread pools of the process and pin it to its cores.
+    The BLAS libraries numpy has already loaded are limited with threadpoolctl, the environment
+    variables are exported for the worker processes spawned afterwards, so this has to be called
+    in the parent before the workers are started and first thing in every worker
+    :param threads: number of threads, 0 keeps the runtime defaults
+    :param affinity: list of the cores the processes may run on, None keeps all cores
+    :param worker: index of the worker process, None for the main process
+    :param workers: number of worker processes
+    """
+    if "threads" in configured:
+        return
+    configured.add("threads")
+
+    if threads:
+        for variable in THREAD_VARIABLES:
+            os.environ[variable] = str(threads)
+
+        # threadpoolctl is installed with scikit-learn
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads)
+
+        import cv2
+        cv2.setNumThreads(threads)
+
+    affinity = cores(affinity, worker, workers)
+    if affinity and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, affinity)
+
+    logger.info('runtime threads: {}, cpu affinity: {}'.format(threads or 'default', affinity or 'all'))
+
+
+def configure_tensorflow(intra_op=config.INTRA_OP_THREADS, inter_op=config.INTER_OP_THREADS):
+    """
+    set the thread pools of tensorflow, which have to be set before its runtime is initialized
+    :param intra_op: number of threads used within an op, 0 lets tensorflow decide
+    :param inter_op: number of ops run in parallel, 0 lets tensorflow decide
+    """
+    configure_threads()
+    if "tensorflow" in configured:
+        return
+    configured.add("tensorflow")
+
+    import tensorflow as tf
+    try:
+        if intra_op:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+        if inter_op:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    except RuntimeError as e:
+        logger.warning('tensorflow thread pools are already initialized: {}'.format(e))
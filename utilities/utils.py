@@ -1,6 +1,9 @@
 import os
 import shutil
 import sys
+import threading
+from queue import Queue, Empty, Full
+from itertools import islice
 from loguru import logger
 from model.utilities.config import config
 import numpy as np
@@ -54,6 +57,80 @@ def get_files(path):
     return next(os.walk(path))[2]
 
 
+def chunked(iterable, size):
+    """
+    split an iterable into lists of at most `size` elements
+    :param iterable: any iterable or generator
+    :param size: maximum length of each chunk
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def prefetch(iterable, size=1):
+    """
+    consume an iterable on a background thread, keeping at most `size`
+    items ready ahead of the caller
+    :param iterable: any iterable or generator
+    :param size: number of items buffered ahead
+    :return: generator yielding the items of the iterable in order
+    """
+    queue = Queue(maxsize=size)
+    sentinel = object()
+    stop = threading.Event()
+
+    def put(item):
+        # wait for free space only as long as the consumer is still iterating
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((sentinel, e))
+        else:
+            put((sentinel, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = queue.get()
+            if item is sentinel:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        # release the items buffered for a consumer that stopped early
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+
+
+def subject_exists(subject):
+    path = os.path.join(config.TRAINED_DATA, f"{subject}{config.CLASSIFIER_FILE_SUFFIX}.sav")
+    if os.path.isfile(path):
+        return subject
+    return False
+
+
 def load_attendance(subject):
     attendance = '{}{}.csv'.format(subject, config.ATTENDANCE_FILE_SUFFIX)
     attendance = os.path.join(config.TRAINED_DATA, attendance)
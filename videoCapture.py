@@ -1,22 +1,44 @@
 import time
+import threading
 import cv2
 import numpy as np
+from collections import deque
 from os.path import basename, isfile
 from model.utilities.config import config
-from model.utilities.image import draw_rectangles, draw_text
+from model.utilities.image import draw_rectangles, draw_text, overlap
+from model.utilities.metrics import metrics
 from filetype import guess
 
 
 class Stream:
 
-    def __init__(self, path, display=False):
+    def __init__(self, path, display=False, interval=config.DETECTION_INTERVAL, rate=config.ANALYSIS_RATE,
+                 threaded=config.THREADED_CAPTURE, scale=None, upsample=None, roi=config.ROI_DETECTION,
+                 identities=config.IDENTITY_CACHE, headless=config.HEADLESS):
         self.path = path
+        # headless streams produce only detections and attendance, without annotations or windows
+        self.headless = headless
+        self.identities = Identities() if identities else None
+        self.roi = roi
+        self.regions = []
+        self.detections = 0
+        # detection resolution of this source, the detector's defaults are used when None
+        self.scale = scale
+        self.upsample = upsample
         self.stream = cv2.VideoCapture(self.path)
+        self.threaded = threaded
+        self.capturer = None
         self.number_of_frames = int(self.stream.get(7))
         self.frame_per_sec = int(self.stream.get(5))
         self.current_index = 0
         self.display = display
-        self.entities = {}
+        self.interval = max(1, interval)
+        self.rate = rate
+        self.presence = Presence()
+
+    @property
+    def entities(self):
+        return self.presence.entities
 
     @staticmethod
     def isValid(path):
@@ -30,16 +52,51 @@ class Stream:
     def verbose_name(path):
         return Stream.isValid(path)
 
-    def __call__(self, model, subject, threshold):
+    def __call__(self, model, subject, threshold, headless=None, sink=None):
+        """
+        recognize and track the faces in the stream
+        :param model: `Predict` object
+        :param subject: name of the subject
+        :param threshold: threshold value for recognizing the faces
+        :param headless: skip annotations and windows, defaults to the stream's mode
+        :param sink: object with a `write(image, name)` method receiving the annotated frames
+        :return: dict of the tracked entities
+        """
+        self.headless = self.headless if headless is None else headless
+        # annotations are only drawn if they are displayed or written to a sink
+        annotate = not self.headless or sink is not None
+        if sink is not None and hasattr(sink, "fps") and not sink.fps:
+            # every frame is written, so a video sink plays at the frame rate of the source
+            sink.fps = self.frame_per_sec
+
+        tracker = FaceTracker()
         for count, frame in self.__iter__():
-            image = frame.track(*(model(image=frame.image, subject=subject, threshold=threshold)))
+            if self.scheduled(frame):
+                # full recognition on the scheduled frames
+                metrics.increment("analysed_frames")
+                labels, trust_vector, faces = self.recognize(model, frame, subject, threshold)
+                if annotate and (self.interval > 1 or self.rate):
+                    tracker.start(frame.image, labels, trust_vector, faces)
+                image = frame.track(labels, trust_vector, faces, annotate=annotate)
+            elif annotate:
+                # follow the recognized faces with the correlation tracker in between
+                with metrics.timer("correlation_track"):
+                    labels, faces = tracker.update(frame.image)
+                image = frame.annotate(labels, faces)
+            else:
+                continue
+
+            if sink is not None:
+                sink.write(image, "frame-{}.jpg".format(count))
+
+            if self.headless:
+                continue
 
             if self.display:
                 cv2.imshow('frame', image)
 
             if cv2.waitKey(1) & 0xFF == ord('q'):
-                self.stream.release()
-                cv2.destroyAllWindows()
+                self.release()
                 break
 
         return self.entities
@@ -48,56 +105,225 @@ class Stream:
         for count, frame in self.__iter__():
             image = frame.image
             if detector:
-                faces = detector.get_all_faces(image=image)
+                faces = detector.get_all_faces(image=image, scale=self.scale, upsample=self.upsample)
                 draw_rectangles(image, faces)
 
             if self.display:
                 cv2.imshow('frame', image)
 
             if cv2.waitKey(1) & 0xFF == ord('q'):
-                self.stream.release()
-                cv2.destroyAllWindows()
+                self.release()
                 break
 
+    @property
+    def live(self):
+        return isinstance(self.path, int) or str(self.path).startswith(("rtsp://", "http://", "https://"))
+
+    def release(self):
+        # stop the capture thread before releasing the capture object it reads from
+        if self.capturer is not None:
+            self.capturer.stop()
+            self.capturer = None
+        if self.stream is not None:
+            self.stream.release()  # When everything done, release the video capture object
+        if not self.headless:
+            cv2.destroyAllWindows()  # Closes all the frames
+
+    def recognize(self, model, frame, subject, threshold):
+        """
+        recognize the faces in the frame, faces whose identity is already confirmed
+        on the previous frames are not encoded and classified again
+        :param model: `Predict` object
+        :param frame: `Frame` object
+        :return: tuple of (labels, trust_vector, faces)
+        """
+        params = dict(image=frame.image, subject=subject, threshold=threshold, scale=self.scale, upsample=self.upsample)
+        if not self.roi and self.identities is None:
+            return model(**params)
+
+        bounding_boxes = self.detect(model.detector, frame)
+        if self.identities is None:
+            return model(bounding_boxes=bounding_boxes, **params)
+
+        cached, bounding_boxes = self.identities.match(bounding_boxes)
+        metrics.increment("cached_faces", len(cached))
+        labels, trust_vector, faces = model(bounding_boxes=bounding_boxes, **params) if bounding_boxes else ([], [], [])
+
+        # a confirmed identity can not appear twice in the frame
+        confirmed = set(track["label"] for track in cached)
+        labels = [label if label not in confirmed else 'unknown' for label in labels]
+
+        ages = [track["age"] for track in cached] + [0] * len(labels)
+        labels = [track["label"] for track in cached] + labels
+        trust_vector = [track["probability"] for track in cached] + trust_vector
+        faces = [track["box"] for track in cached] + faces
+
+        self.identities.update(labels, trust_vector, faces, ages, self.entities)
+        return labels, trust_vector, faces
+
+    def detect(self, detector, frame):
+        """
+        find the faces only around the faces of the last analysed frame,
+        the whole frame is scanned periodically and whenever a face is lost
+        :param detector: `FaceDetector` object
+        :param frame: `Frame` object
+        :return: dlib.rectangles
+        """
+        with metrics.timer("detect"):
+            if not self.roi:
+                return detector.get_all_faces(image=frame.image, scale=self.scale, upsample=self.upsample)
+
+            refresh = not self.regions or self.detections % config.ROI_REFRESH == 0
+            if not refresh:
+                faces = detector.get_faces_around(frame.image, self.regions, upsample=self.upsample)
+                refresh = len(faces) < len(self.regions)
+
+            if refresh:
+                faces = detector.get_all_faces(image=frame.image, scale=self.scale, upsample=self.upsample)
+
+        self.detections += 1
+        self.regions = list(faces)
+        return faces
+
+    def scheduled(self, frame):
+        """
+        decide whether the full recognition pipeline is to be run on the frame,
+        either every `interval` frames or at `rate` frames per second of the stream
+        :param frame: `Frame` object
+        :return: bool
+        """
+        if self.rate:
+            timestamp = frame.timestamp if frame.timestamp else (time.time() - self.start_time) * 1000
+            if self.last_scheduled is None or timestamp - self.last_scheduled >= 1000 / self.rate:
+                self.last_scheduled = timestamp
+                return True
+            return False
+
+        return (self.current_index - 1) % self.interval == 0
+
     def __len__(self):
         return self.number_of_frames
 
     def __iter__(self):
         self.start_time = time.time()
         self.current_index = 0
+        self.last_scheduled = None
+        self.regions = []
+        self.detections = 0
+        if self.identities is not None:
+            self.identities = Identities()
         if not self.path == 0:
             self.stream = cv2.VideoCapture(self.path)
 
         self.number_of_frames = int(self.stream.get(7))
+        if self.threaded:
+            # live sources keep only the latest frames, files are read without dropping any
+            self.capturer = Capture(self.stream, size=config.CAPTURE_BUFFER, lossless=not self.live)
         return self
 
+    def read(self):
+        if self.capturer is not None:
+            metrics.gauge("capture_buffer", len(self.capturer.buffer))
+            return self.capturer.read()
+        ret, frame = self.stream.read()
+        return ret, frame, self.stream.get(0) if ret else None
+
     def __next__(self):
         self.current_index += 1
-        ret, frame = self.stream.read()  # ret is false at EOF
+        ret, frame, timestamp = self.read()  # ret is false at EOF
         if ret is False:
-            self.stream.release()  # When everything done, release the video capture object
-            cv2.destroyAllWindows()  # Closes all the frames
+            self.release()
             self.current_index = None
             self.stream = None
             raise StopIteration  # stop the loop
 
         elif ret is True:
+            metrics.increment("frames")
             # cv2 opens in bgr mode and needs to be converted to RGB
-            return self.current_index, Frame(parent=self, image=frame, timestamp=self.stream.get(0))
-
-
-class Frame(Stream):
-
-    def __init__(self, image, timestamp, parent=None, path=None):
-        if isinstance(parent, Stream):
-            self.__dict__ = parent.__dict__.copy()
-        else:
-            super(Frame, self).__init__(path=path)
+            return self.current_index, Frame(image=frame, timestamp=timestamp, index=self.current_index, stream=self)
+
+
+class Capture:
+    """
+    Reads the frames of a `cv2.VideoCapture` on a background thread into a bounded buffer
+    so decoding never stalls recognition. In lossless mode the reader waits for free space
+    in the buffer, otherwise the oldest frames are dropped and `read` returns the latest one.
+    """
+
+    def __init__(self, stream, size=config.CAPTURE_BUFFER, lossless=True):
+        self.stream = stream
+        self.size = max(1, size)
+        self.lossless = lossless
+        self.buffer = deque(maxlen=None if lossless else self.size)
+        self.condition = threading.Condition()
+        self.finished = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped:
+            ret, frame = self.stream.read()
+            timestamp = self.stream.get(0) if ret else None
+            with self.condition:
+                if not ret:
+                    break
+                while self.lossless and len(self.buffer) >= self.size and not self.stopped:
+                    self.condition.wait()
+                self.buffer.append((frame, timestamp))
+                self.condition.notify_all()
+
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def read(self):
+        """
+        :return: tuple of (ret, frame, timestamp), ret is False once the stream is exhausted
+        """
+        with self.condition:
+            while not self.buffer and not self.finished:
+                self.condition.wait()
+
+            if not self.buffer:
+                return False, None, None
+
+            if self.lossless:
+                frame, timestamp = self.buffer.popleft()
+            else:
+                frame, timestamp = self.buffer.pop()
+                self.buffer.clear()
+
+            self.condition.notify_all()
+            return True, frame, timestamp
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class Frame:
+    """
+    A decoded frame of a `Stream` and the faces recognized in it. The detections are
+    stored as arrays: labels, trust scores and boxes as (left, top, right, bottom) rows.
+    """
+
+    __slots__ = ("image", "timestamp", "index", "stream", "labels", "trust_vector", "boxes")
+
+    def __init__(self, image, timestamp, index=None, stream=None):
         self.image = image
         self.timestamp = timestamp
-        self.labels = []
-        self.trust_vector = []
-        self.faces = []
+        self.index = index
+        self.stream = stream
+        self.labels = np.empty(0, dtype=object)
+        self.trust_vector = np.empty(0, dtype=np.float32)
+        self.boxes = np.empty((0, 4), dtype=np.int32)
+
+    @property
+    def entities(self):
+        return self.stream.entities
 
     def __str__(self):
         return "timestamp: {}, entities: {}".format(self.timestamp / 1000, self.labels)
@@ -105,49 +331,214 @@ class Frame(Stream):
     def __repr__(self):
         return "timestamp: {}, entities: {}".format(self.timestamp / 1000, self.labels)
 
-    def track(self, labels, trust_vector, faces):
-        image = self.image.copy()
-        self.labels.extend(labels)
-        self.trust_vector.extend(trust_vector)
-        self.faces.extend(faces)
+    def track(self, labels, trust_vector, faces, annotate=True):
+        self.labels = np.asarray(labels, dtype=object)
+        self.trust_vector = np.asarray(trust_vector, dtype=np.float32)
+        self.boxes = np.array([(face.left(), face.top(), face.right(), face.bottom()) for face in faces],
+                              dtype=np.int32).reshape(-1, 4)
 
-        for label, probability, face in zip(labels, trust_vector, faces):
-            student = self.entities.setdefault(label, Tracker(max_frames=5))
-            student.present_in_frame(probability)
-            student.frames = self
+        with metrics.timer("track"):
+            self.stream.presence.update(self)
+        return self.annotate(labels, faces) if annotate else None
 
+    def annotate(self, labels, faces):
+        image = self.image.copy()
+        for label, face in zip(labels, faces):
             draw_rectangles(image, [face])
             draw_text(image=image, text=label, face_location=face)
-
-            missing_entities = self.missing_in_current_frame()
-
-            for entity in missing_entities:
-                # reduce count by one if a person is missing after appearing in the previous frame
-                entity.not_present_in_frame()
-
-        else:
-            if self.entities.get("unknown"):
-                self.entities.pop("unknown")
-
         return image
 
     def missing_in_current_frame(self):
-        prev_detected = set(self.entities.keys())
-        in_curr_frame = set(self.labels)
-        not_detected = prev_detected - in_curr_frame
-        return [self.entities[entity] for entity in not_detected]
+        return self.stream.presence.missing(self.labels)
+
+
+class Identities:
+    """
+    Identities of the faces confirmed present with a high trust score, reused on
+    the following frames while the face stays in place so that it is not encoded
+    and classified again. Every identity is verified again after `reverify` frames.
+    """
+
+    def __init__(self, trust=config.IDENTITY_TRUST, reverify=config.IDENTITY_REVERIFY,
+                 threshold=config.IDENTITY_OVERLAP):
+        self.trust = trust
+        self.reverify = reverify
+        self.threshold = threshold
+        self.tracks = []
+
+    def match(self, bounding_boxes):
+        """
+        :param bounding_boxes: faces detected in the current frame
+        :return: tuple of (tracks matching a face, faces still to be recognized)
+        """
+        cached, remaining, tracks = [], [], list(self.tracks)
+        for box in bounding_boxes:
+            scores = [overlap(box, track["box"]) for track in tracks]
+            best = int(np.argmax(scores)) if scores else None
+
+            # the face has not moved much and the identity is not due for verification
+            if best is not None and scores[best] >= self.threshold and tracks[best]["age"] < self.reverify:
+                track = tracks.pop(best)
+                cached.append(dict(track, box=box, age=track["age"] + 1))
+            else:
+                remaining.append(box)
+
+        return cached, remaining
+
+    def update(self, labels, trust_vector, faces, ages, entities):
+        self.tracks = []
+        for label, probability, face, age in zip(labels, trust_vector, faces, ages):
+            tracker = entities.get(label)
+            if label != 'unknown' and tracker is not None and tracker.present and probability >= self.trust:
+                self.tracks.append({"label": label, "probability": probability, "box": face, "age": age})
+
+
+class FaceTracker:
+    """
+    Cheap correlation tracker following the recognized faces between
+    the frames on which the full recognition pipeline is run.
+    """
+
+    def __init__(self):
+        self.trackers = []
+        self.labels = []
+        self.trust_vector = []
+
+    def start(self, image, labels, trust_vector, faces):
+        import dlib
+
+        self.trackers = []
+        self.labels = list(labels)
+        self.trust_vector = list(trust_vector)
+        for face in faces:
+            tracker = dlib.correlation_tracker()
+            tracker.start_track(image, face)
+            self.trackers.append(tracker)
+
+    def update(self, image):
+        """
+        :param image: the next frame
+        :return: tuple of (labels, faces) with the tracked face locations
+        """
+        import dlib
+
+        faces = []
+        for tracker in self.trackers:
+            tracker.update(image)
+            position = tracker.get_position()
+            faces.append(dlib.rectangle(int(position.left()), int(position.top()),
+                                        int(position.right()), int(position.bottom())))
+        return self.labels, faces
+
+
+class Presence:
+    """
+    Presence bookkeeping of all the entities of a stream, kept in arrays indexed by
+    the row of each label so that a frame is tracked with a constant number of
+    vectorised operations. Besides the consecutive frame count, only running aggregates
+    of the trust scores and timestamps are kept, plus at most `keyframes` downscaled
+    thumbnails per entity, so the memory used is constant for arbitrarily long streams.
+    """
+
+    def __init__(self, max_frames=config.MAX_FRAME, keyframes=config.TRACKER_KEYFRAMES):
+        self.frame_threshold = max_frames
+        self.keyframes = keyframes
+        self.rows = {}
+        self.labels = np.empty(0, dtype=object)
+        self.count = np.zeros(0, dtype=np.int32)
+        self.detected = np.zeros(0, dtype=bool)
+        self.present = np.zeros(0, dtype=bool)
+        self.appearances = np.zeros(0, dtype=np.int64)
+        self.total = np.zeros(0, dtype=np.float64)
+        self.maximum = np.zeros(0, dtype=np.float64)
+        self.first_seen = np.zeros(0, dtype=np.float64)
+        self.last_seen = np.zeros(0, dtype=np.float64)
+        self.thumbnails = []
+        self.entities = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def enroll(self, labels):
+        """
+        add rows for the labels not seen before
+        :param labels: list of labels
+        :return: array of the rows of the labels
+        """
+        new = [label for label in dict.fromkeys(labels) if label not in self.rows]
+        if new:
+            size = len(new)
+            for label in new:
+                self.rows[label] = len(self.rows)
+                self.entities[label] = Tracker(self, self.rows[label])
+                self.thumbnails.append(deque(maxlen=self.keyframes))
+
+            self.labels = np.concatenate([self.labels, np.array(new, dtype=object)])
+            self.count = np.concatenate([self.count, np.zeros(size, dtype=np.int32)])
+            self.detected = np.concatenate([self.detected, np.ones(size, dtype=bool)])
+            self.present = np.concatenate([self.present, np.zeros(size, dtype=bool)])
+            self.appearances = np.concatenate([self.appearances, np.zeros(size, dtype=np.int64)])
+            self.total = np.concatenate([self.total, np.zeros(size)])
+            self.maximum = np.concatenate([self.maximum, np.full(size, np.nan)])
+            self.first_seen = np.concatenate([self.first_seen, np.full(size, np.nan)])
+            self.last_seen = np.concatenate([self.last_seen, np.full(size, np.nan)])
+
+        return np.fromiter((self.rows[label] for label in labels), dtype=np.intp, count=len(labels))
+
+    def update(self, frame):
+        """
+        track the entities recognized in the frame in a single pass
+        :param frame: `Frame` object
+        """
+        if len(frame.labels) == 0:
+            return
+
+        # unknown faces are not tracked
+        known = frame.labels != 'unknown'
+        rows = self.enroll(frame.labels[known].tolist())
+        trust_vector = frame.trust_vector[known]
+
+        # aggregates of the trust scores and timestamps
+        self.appearances[rows] += 1
+        self.total[rows] += trust_vector
+        self.maximum[rows] = np.fmax(self.maximum[rows], trust_vector)
+        self.first_seen[rows] = np.where(np.isnan(self.first_seen[rows]), frame.timestamp, self.first_seen[rows])
+        self.last_seen[rows] = frame.timestamp
+
+        # entities appearing in less than `frame_threshold` consecutive frames are counted,
+        # the others are marked present
+        counting = self.count[rows] < self.frame_threshold
+        self.count[rows[counting]] += 1
+        self.detected[rows[counting]] = True
+        self.present[rows[~counting]] = True
+
+        # reduce count by one if a person is missing after appearing in the previous frame
+        missing = self.detected & ~self.present
+        missing[rows] = False
+        self.count[missing] -= 1
+        self.detected[missing] = False
+
+        if self.keyframes:
+            thumbnail = Tracker.thumbnail(frame.image)
+            for row in rows:
+                self.thumbnails[row].append((frame.timestamp, thumbnail))
+
+    def missing(self, labels):
+        mask = np.ones(len(self), dtype=bool)
+        mask[[self.rows[label] for label in labels if label in self.rows]] = False
+        return [self.entities[label] for label in self.labels[mask]]
 
 
 class Tracker:
+    """
+    View of the presence of a single entity in the arrays of its `Presence`.
+    """
 
-    def __init__(self, max_frames=config.MAX_FRAME):
-        self.detected = True
-        self.count = 0
-        self.present = False
-        self.frame_threshold = max_frames
-        self.__trust_vector = []
-        self.__probability = None
-        self.__frames = []
+    __slots__ = ("presence", "row")
+
+    def __init__(self, presence, row):
+        self.presence = presence
+        self.row = row
 
     def __str__(self):
         return "count: {}, present: {}, probability: {}".format(self.count, self.present, self.probability)
@@ -156,65 +547,45 @@ class Tracker:
         return "count: {}, present: {}, probability: {}".format(self.count, self.present, self.probability)
 
     @property
-    def trust_vector(self):
-        return self.__trust_vector
+    def count(self):
+        return int(self.presence.count[self.row])
 
-    @trust_vector.setter
-    def trust_vector(self, value):
-        if hasattr(value, "__iter__"):
-            self.__trust_vector.extend([i for i in value if isinstance(i, int) or isinstance(i, float)])
-        else:
-            self.__trust_vector.append(value)
+    @property
+    def detected(self):
+        return bool(self.presence.detected[self.row])
+
+    @property
+    def present(self):
+        return bool(self.presence.present[self.row])
+
+    @property
+    def trust_vector(self):
+        # summary of the trust scores, the individual scores are not kept
+        return {"count": int(self.presence.appearances[self.row]), "mean": self.probability,
+                "max": float(self.presence.maximum[self.row])}
 
     @property
     def probability(self):
-        if self.__probability:
-            return self.__probability
-        else:
-            self.align_trust_vector()
-            return self.probability
-
-    @probability.setter
-    def probability(self, value):
-        if self.__probability:
-            self.align_trust_vector(value)
-        else:
-            self.__probability = value
+        # average trust score over all the frames the entity appeared in
+        appearances = self.presence.appearances[self.row]
+        return float(self.presence.total[self.row] / appearances) if appearances else None
+
+    @property
+    def first_seen(self):
+        return float(self.presence.first_seen[self.row])
+
+    @property
+    def last_seen(self):
+        return float(self.presence.last_seen[self.row])
 
     @property
     def frames(self):
-        return self.__frames
-
-    @frames.setter
-    def frames(self, value):
-        if isinstance(value, Frame):
-            self.__frames.append(value)
-        elif hasattr(value, "__iter__"):
-            self.__frames.extend([obj for obj in value if isinstance(obj, Frame)])
-        else:
-            raise ValueError("value should be an instance of Frame class")
-
-    def align_trust_vector(self, *args):
-        if self.trust_vector:
-            self.trust_vector = args
-            array = np.array(self.trust_vector)
-            averaged = np.average(array)
-            self.__probability = averaged
-
-    def present_in_frame(self, probability):
-        self.trust_vector = probability
-        if self.count < self.frame_threshold:
-            self.count += 1
-            self.detected = True
-        else:
-            self.present = True
-
-    def not_present_in_frame(self):
-        # self.detected => entity was present in last frame
-        # self.present => and it has not been marked present
-        if self.detected and not self.present:
-            self.count -= 1
-            self.detected = False
+        return list(self.presence.thumbnails[self.row])
+
+    @staticmethod
+    def thumbnail(image, width=config.TRACKER_THUMBNAIL):
+        height = int(image.shape[0] * width / image.shape[1])
+        return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
 
 
 if __name__ == "__main__":